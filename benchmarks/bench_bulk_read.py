@@ -0,0 +1,113 @@
+'''Benchmark fly-scan datum generation for the Xspress3 bulk_read
+
+Compares the per-datum path (a uuid4 and a kwargs dictionary per datum,
+inserted in one call) against the columnar path (ids derived from the
+resource id, kwargs built from arrays and inserted in chunks), reporting
+time and peak traced memory as the number of points grows.
+
+Insertion itself is replaced by a sink which, like filestore, builds one
+document per datum of each insert call before discarding them, so that the
+numbers reflect the datum generation cost.  The peak memory of each path
+is also given relative to the per-datum path.
+
+Usage, from the repository root after ``pip install -e .``::
+
+    python benchmarks/bench_bulk_read.py [--points N [N ...]] [--channels N]
+'''
+from __future__ import print_function
+import argparse
+import itertools
+import uuid
+
+import numpy as np
+
+from hxntools.detectors.datum_writer import (columnar_datum_ids,
+                                             bulk_insert_datum_columns,
+                                             DEFAULT_CHUNK_SIZE)
+
+from bench_utils import measure
+
+
+class Sink(object):
+    '''Stand-in for bulk_insert_datum, building and dropping the documents'''
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, resource, uids, datum_kwargs):
+        docs = [{'resource': resource['id'], 'datum_id': uid,
+                 'datum_kwargs': kwargs}
+                for uid, kwargs in zip(uids, datum_kwargs)]
+        self.count += len(docs)
+
+
+def per_datum(resource, channels, count, insert):
+    '''The original bulk_read datum generation'''
+    ch_uids = {ch: [str(uuid.uuid4()) for _ in range(count)]
+               for ch in channels}
+
+    def get_datum_args():
+        for ch in channels:
+            for seq_num in range(count):
+                yield {'frame': seq_num,
+                       'channel': ch}
+
+    uids = [ch_uids[ch] for ch in channels]
+    insert(resource, itertools.chain(*uids), get_datum_args())
+    return ch_uids
+
+
+def columnar(resource, channels, count, insert, chunk_size):
+    '''The columnar bulk_read datum generation'''
+    frames = np.arange(count)
+    call_id = str(uuid.uuid4())
+    ch_uids = {}
+    for ch in channels:
+        uids = columnar_datum_ids(resource['id'], ch, range(count),
+                                  call_id=call_id)
+        bulk_insert_datum_columns(
+            resource, uids, {'frame': frames,
+                             'channel': np.full(count, ch, dtype=int)},
+            chunk_size=chunk_size, insert=insert)
+        ch_uids[ch] = uids
+    return ch_uids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--points', type=int, nargs='+',
+                        default=[10000, 100000, 500000],
+                        help='Fly scan point counts')
+    parser.add_argument('--channels', type=int, default=3,
+                        help='Xspress3 channels')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help='Datums per insertion (columnar path)')
+    args = parser.parse_args()
+
+    resource = {'id': str(uuid.uuid4())}
+    channels = list(range(1, args.channels + 1))
+
+    header = '{:>10} {:<10} {:>10} {:>12} {:>10} {:>10}'.format(
+        'points', 'path', 'time (s)', 'datums/s', 'peak MB', 'peak ratio')
+    print(header)
+    print('-' * len(header))
+
+    for count in args.points:
+        paths = [('per-datum', lambda sink: per_datum(resource, channels,
+                                                      count, sink)),
+                 ('columnar', lambda sink: columnar(resource, channels,
+                                                    count, sink,
+                                                    args.chunk_size)),
+                 ]
+        baseline_peak = None
+        for name, func in paths:
+            sink = Sink()
+            _, elapsed, peak = measure(lambda: func(sink))
+            if baseline_peak is None:
+                baseline_peak = peak
+            print('{:>10} {:<10} {:>10.3f} {:>12.0f} {:>10.1f} {:>10.2f}'
+                  ''.format(count, name, elapsed, sink.count / elapsed,
+                            peak / 1024. ** 2, peak / baseline_peak))
+
+
+if __name__ == '__main__':
+    main()
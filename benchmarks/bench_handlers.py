@@ -0,0 +1,271 @@
+'''Benchmark the filestore handler read paths on synthetic detector files
+
+Generates Xspress3-like (frames x channels x bins) and Timepix/Merlin-like
+(frames x rows x cols) HDF5 files with several chunk layouts, with and
+without zlib compression, then times the handler read paths and reports
+throughput, latency percentiles and peak memory.  Memory is the peak of
+the allocations traced by tracemalloc during each case (numpy buffers
+included), so cases do not inherit each other's high-water mark.
+
+Usage, from the repository root after ``pip install -e .``::
+
+    python benchmarks/bench_handlers.py [--frames N] [--tpx-frames N] ...
+
+Files are written to a temporary directory unless --directory is given.
+'''
+from __future__ import print_function
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+
+import h5py
+import numpy as np
+
+from hxntools.handlers.file_pool import get_file_pool
+from hxntools.handlers.xspress3 import (Xspress3HDF5Handler, XRF_DATA_KEY)
+from hxntools.handlers.timepix import TimepixHDF5Handler
+
+from bench_utils import measure
+
+
+XSP3_LAYOUTS = OrderedDict([
+    ('frame', lambda ch, bins: (1, ch, bins)),
+    ('frame-channel', lambda ch, bins: (1, 1, bins)),
+    ('block64', lambda ch, bins: (64, ch, bins)),
+])
+
+TPX_LAYOUTS = OrderedDict([
+    ('frame', lambda rows, cols: (1, rows, cols)),
+    ('block8', lambda rows, cols: (8, rows, cols)),
+])
+
+COMPRESSIONS = OrderedDict([
+    ('none', {}),
+    ('zlib', dict(compression='gzip', compression_opts=6)),
+])
+
+
+def _write_dataset(filename, key, shape, chunks, dtype, compression_kw,
+                   make_block, *, block_frames=256):
+    '''Write a synthetic dataset one block of frames at a time'''
+    with h5py.File(filename, 'w') as f:
+        if compression_kw or chunks is not None:
+            ds = f.create_dataset(key, shape=shape, dtype=dtype,
+                                  chunks=chunks, **compression_kw)
+        else:
+            ds = f.create_dataset(key, shape=shape, dtype=dtype)
+
+        for start in range(0, shape[0], block_frames):
+            stop = min(start + block_frames, shape[0])
+            ds[start:stop] = make_block(stop - start)
+
+
+def make_xspress3_file(filename, frames, channels, bins, chunks,
+                       compression_kw):
+    rng = np.random.RandomState(0)
+    energies = np.arange(bins)
+    # a few fluorescence lines on a flat background
+    spectrum = 2 + sum(500 * np.exp(-0.5 * ((energies - center) / 15) ** 2)
+                       for center in (bins * 0.2, bins * 0.35, bins * 0.6))
+
+    def make_block(count):
+        return rng.poisson(spectrum, size=(count, channels, bins))
+
+    _write_dataset(filename, XRF_DATA_KEY, (frames, channels, bins),
+                   chunks, np.uint32, compression_kw, make_block)
+
+
+def make_timepix_file(filename, frames, rows, cols, chunks, compression_kw):
+    rng = np.random.RandomState(1)
+    yy, xx = np.mgrid[:rows, :cols]
+    # a diffraction-like central peak
+    pattern = 1000 * np.exp(-((yy - rows / 2) ** 2 + (xx - cols / 2) ** 2) /
+                            (2 * (rows / 16) ** 2)) + 0.5
+
+    def make_block(count):
+        return rng.poisson(pattern, size=(count, rows, cols))
+
+    _write_dataset(filename, TimepixHDF5Handler.hardcoded_key,
+                   (frames, rows, cols), chunks, np.uint16, compression_kw,
+                   make_block, block_frames=32)
+
+
+def _percentiles(latencies):
+    latencies = np.asarray(latencies) * 1e3
+    return tuple(np.percentile(latencies, (50, 90, 99)))
+
+
+class Report(object):
+    header = ('{:<34} {:<22} {:>10} {:>9} {:>9} {:>9} {:>9} {:>10}'
+              ''.format('file', 'operation', 'time (s)', 'MB/s', 'p50 ms',
+                        'p90 ms', 'p99 ms', 'peak MB'))
+
+    def __init__(self):
+        self.rows = []
+        print(self.header)
+        print('-' * len(self.header))
+
+    def add(self, name, operation, elapsed, nbytes, peak, latencies=None):
+        if latencies:
+            p50, p90, p99 = _percentiles(latencies)
+        else:
+            p50 = p90 = p99 = float('nan')
+
+        mb_per_sec = (nbytes / 1024. ** 2) / elapsed if elapsed else 0.
+        row = (name, operation, elapsed, mb_per_sec, p50, p90, p99,
+               peak / 1024. ** 2)
+        self.rows.append(row)
+        print('{:<34} {:<22} {:>10.3f} {:>9.1f} {:>9.3f} {:>9.3f} {:>9.3f} '
+              '{:>10.1f}'.format(*row))
+
+
+def bench_xspress3(filename, name, report, *, num_datums, num_rois):
+    handler = Xspress3HDF5Handler(filename, roi_cache=None)
+    try:
+        dataset = handler._full_dataset()
+        frames, channels, bins = dataset.shape
+        itemsize = dataset.dtype.itemsize
+        rng = np.random.RandomState(2)
+
+        latencies = []
+
+        def per_datum():
+            for frame in rng.randint(0, frames, num_datums):
+                t0 = time.perf_counter()
+                # copy, so memory-mapped reads are actually paged in
+                np.array(handler(frame=int(frame), channel=1))
+                latencies.append(time.perf_counter() - t0)
+
+        _, elapsed, peak = measure(per_datum)
+        report.add(name, 'xsp3 __call__', elapsed,
+                   num_datums * bins * itemsize, peak, latencies)
+
+        width = bins // (2 * num_rois)
+        rois = [(1 + idx % channels, 2 * idx * width, (2 * idx + 1) * width)
+                for idx in range(num_rois)]
+        roi_bytes = frames * width * itemsize
+
+        _, elapsed, peak = measure(
+            lambda: [handler.get_roi(*roi) for roi in rois])
+        report.add(name, 'xsp3 get_roi x{}'.format(num_rois), elapsed,
+                   num_rois * roi_bytes, peak)
+
+        _, elapsed, peak = measure(lambda: handler.get_rois(rois))
+        report.add(name, 'xsp3 get_rois', elapsed, num_rois * roi_bytes,
+                   peak)
+
+        _, elapsed, peak = measure(lambda: handler.get_frames(range(frames)))
+        report.add(name, 'xsp3 full map', elapsed,
+                   frames * channels * bins * itemsize, peak)
+    finally:
+        handler.close()
+
+
+def bench_timepix(filename, name, report, *, num_datums):
+    handler = TimepixHDF5Handler(filename)
+    try:
+        dataset = handler._get_dataset()
+        frames = dataset.shape[0]
+        frame_nbytes = int(np.prod(dataset.shape[1:])) * dataset.dtype.itemsize
+        rng = np.random.RandomState(3)
+
+        latencies = []
+
+        def per_datum():
+            for frame in rng.randint(0, frames, num_datums):
+                t0 = time.perf_counter()
+                np.array(handler(int(frame)))
+                latencies.append(time.perf_counter() - t0)
+
+        _, elapsed, peak = measure(per_datum)
+        report.add(name, 'tpx __call__', elapsed, num_datums * frame_nbytes,
+                   peak, latencies)
+
+        _, elapsed, peak = measure(lambda: np.array(handler.get_frames()))
+        report.add(name, 'tpx full load', elapsed, frames * frame_nbytes,
+                   peak)
+
+        _, elapsed, peak = measure(handler.sum_frames)
+        report.add(name, 'tpx sum_frames', elapsed, frames * frame_nbytes,
+                   peak)
+    finally:
+        handler.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--frames', type=int, default=20000,
+                        help='Xspress3 frames per file')
+    parser.add_argument('--channels', type=int, default=3,
+                        help='Xspress3 channels')
+    parser.add_argument('--bins', type=int, default=4096,
+                        help='Xspress3 bins per spectrum')
+    parser.add_argument('--tpx-frames', type=int, default=1000,
+                        help='Timepix/Merlin frames per file')
+    parser.add_argument('--tpx-size', type=int, default=512,
+                        help='Timepix/Merlin frame size (square)')
+    parser.add_argument('--datums', type=int, default=200,
+                        help='Random datums to fill per file')
+    parser.add_argument('--rois', type=int, default=16,
+                        help='Number of ROIs for the ROI benchmarks')
+    parser.add_argument('--directory', default=None,
+                        help='Where to write the files (kept afterwards)')
+    parser.add_argument('--skip-xspress3', action='store_true')
+    parser.add_argument('--skip-timepix', action='store_true')
+    args = parser.parse_args()
+
+    directory = args.directory
+    cleanup = directory is None
+    if cleanup:
+        directory = tempfile.mkdtemp(prefix='hxntools_bench_')
+    else:
+        os.makedirs(directory, exist_ok=True)
+
+    report = Report()
+    try:
+        for compression, compression_kw in COMPRESSIONS.items():
+            if not args.skip_xspress3:
+                layouts = list(XSP3_LAYOUTS.items())
+                if not compression_kw:
+                    layouts.insert(0, ('contiguous', lambda ch, bins: None))
+
+                for layout, make_chunks in layouts:
+                    name = 'xsp3_{}_{}'.format(layout, compression)
+                    filename = os.path.join(directory, name + '.h5')
+                    if not os.path.exists(filename):
+                        make_xspress3_file(
+                            filename, args.frames, args.channels, args.bins,
+                            make_chunks(args.channels, args.bins),
+                            compression_kw)
+                    bench_xspress3(filename, name, report,
+                                   num_datums=args.datums,
+                                   num_rois=args.rois)
+
+            if not args.skip_timepix:
+                layouts = list(TPX_LAYOUTS.items())
+                if not compression_kw:
+                    layouts.insert(0, ('contiguous', lambda rows, cols: None))
+
+                size = args.tpx_size
+                for layout, make_chunks in layouts:
+                    name = 'tpx_{}_{}'.format(layout, compression)
+                    filename = os.path.join(directory, name + '.h5')
+                    if not os.path.exists(filename):
+                        make_timepix_file(filename, args.tpx_frames, size,
+                                          size, make_chunks(size, size),
+                                          compression_kw)
+                    bench_timepix(filename, name, report,
+                                  num_datums=args.datums)
+
+            get_file_pool().clear()
+    finally:
+        get_file_pool().clear()
+        if cleanup:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
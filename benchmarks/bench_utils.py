@@ -0,0 +1,16 @@
+'''Helpers shared by the benchmark scripts'''
+import time
+import tracemalloc
+
+
+def measure(func):
+    '''Run func, returning (result, elapsed seconds, peak traced bytes)'''
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    try:
+        result = func()
+        elapsed = time.perf_counter() - t0
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, elapsed, peak
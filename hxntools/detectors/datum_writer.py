@@ -0,0 +1,221 @@
+import logging
+import threading
+import time
+
+import numpy as np
+from filestore.api import bulk_insert_datum
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 10000
+
+
+class DatumWriterError(RuntimeError):
+    '''Raised when background datum insertion failed'''
+
+
+class WriteBehindDatumWriter(object):
+    '''Buffer filestore datums and insert them in batches in the background
+
+    `add` only appends to an in-memory buffer; a worker thread inserts the
+    buffered datums once `max_batch` are waiting or the oldest has waited
+    `max_latency` seconds.  A failed insertion is raised from the next call
+    to `add`, `flush` or `close`.
+
+    Parameters
+    ----------
+    resource : dict
+        The filestore resource the datums refer to
+    max_batch : int, optional
+        Insert as soon as this many datums are buffered
+    max_latency : float, optional
+        Maximum time, in seconds, a datum stays in the buffer
+    insert : callable, optional
+        insert(resource, uids, datum_kwargs), defaults to bulk_insert_datum
+    '''
+    def __init__(self, resource, *, max_batch=1000, max_latency=1.0,
+                 insert=bulk_insert_datum):
+        self.resource = resource
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self._insert = insert
+
+        self._cond = threading.Condition()
+        self._uids = []
+        self._datum_kwargs = []
+        self._first_added = None
+        self._flush_requested = False
+        self._in_flight = False
+        self._closed = False
+        self._error = None
+
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='datum_writer')
+        self._thread.start()
+
+    def add(self, uids, datum_kwargs):
+        '''Buffer datums for insertion
+
+        Parameters
+        ----------
+        uids : sequence of str
+        datum_kwargs : sequence of dict
+        '''
+        self.check()
+        with self._cond:
+            if self._closed:
+                raise DatumWriterError('Datum writer is closed')
+
+            if not self._uids:
+                self._first_added = time.monotonic()
+            self._uids.extend(uids)
+            self._datum_kwargs.extend(datum_kwargs)
+            if len(self._uids) >= self.max_batch:
+                self._cond.notify_all()
+
+    def check(self):
+        '''Raise DatumWriterError if a background insertion failed'''
+        with self._cond:
+            error, self._error = self._error, None
+
+        if error is not None:
+            raise DatumWriterError('Background datum insertion failed for '
+                                   'resource {}'.format(self.resource)
+                                   ) from error
+
+    def flush(self, timeout=None):
+        '''Insert all buffered datums, waiting for completion
+
+        Returns False if the timeout expired first.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._flush_requested = True
+            self._cond.notify_all()
+            try:
+                while self._uids or self._in_flight:
+                    remaining = (None if deadline is None
+                                 else deadline - time.monotonic())
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+            finally:
+                # back to batching, even if the flush timed out
+                self._flush_requested = False
+
+        self.check()
+        return True
+
+    def close(self, timeout=None):
+        '''Flush the buffer and stop the background thread'''
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning('Datum writer still busy after %s s; %d datums '
+                           'pending', timeout, len(self._uids))
+        self.check()
+
+    def _ready(self):
+        '''Whether the buffered datums should be inserted now'''
+        if not self._uids:
+            return False
+        if self._closed or self._flush_requested:
+            return True
+        if len(self._uids) >= self.max_batch:
+            return True
+        return time.monotonic() - self._first_added >= self.max_latency
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._ready():
+                    if self._closed and not self._uids:
+                        return
+
+                    timeout = None
+                    if self._uids:
+                        timeout = max(0, self.max_latency -
+                                      (time.monotonic() - self._first_added))
+                    self._cond.wait(timeout)
+
+                uids, self._uids = self._uids, []
+                datum_kwargs, self._datum_kwargs = self._datum_kwargs, []
+                self._in_flight = True
+
+            try:
+                self._insert(self.resource, uids, datum_kwargs)
+            except Exception as ex:
+                logger.exception('Failed to insert %d datums', len(uids))
+                with self._cond:
+                    if self._error is None:
+                        self._error = ex
+            finally:
+                with self._cond:
+                    self._in_flight = False
+                    self._cond.notify_all()
+
+
+def columnar_datum_ids(resource_id, channel, frames, *, call_id=None):
+    '''Datum ids derived from the resource, '{resource_id}/{channel}/{frame}'
+
+    The ids are deterministic, so inserting the same frames of a resource
+    twice fails on duplicate keys.  Callers which may insert them more than
+    once (e.g., a repeated bulk_read) should pass a new `call_id` each time,
+    giving '{resource_id}/{call_id}/{channel}/{frame}'.
+
+    The ids are built straight into the list that is returned to the
+    RunEngine; a fixed-width numpy string array would take 4 bytes per
+    character on top of that.
+
+    Parameters
+    ----------
+    resource_id : str
+        The filestore resource id (unique per file)
+    channel : int
+    frames : iterable of int
+        e.g., range(num_frames)
+    call_id : str, optional
+        Distinguishes the ids of separate insertions of the same frames
+
+    Returns
+    -------
+    datum_ids : list of str
+    '''
+    if call_id is None:
+        prefix = '{}/{}/'.format(resource_id, channel)
+    else:
+        prefix = '{}/{}/{}/'.format(resource_id, call_id, channel)
+    return [prefix + str(frame) for frame in frames]
+
+
+def bulk_insert_datum_columns(resource, datum_ids, columns, *,
+                              chunk_size=DEFAULT_CHUNK_SIZE,
+                              insert=bulk_insert_datum):
+    '''Insert datums with their kwargs given column-wise, in chunks
+
+    Only one chunk of kwarg dictionaries exists at a time.
+
+    Parameters
+    ----------
+    resource : dict
+        The filestore resource
+    datum_ids : list of str
+    columns : dict
+        {kwarg name: array}, each the same length as datum_ids
+    chunk_size : int, optional
+        Number of datums per insertion
+    insert : callable, optional
+        insert(resource, uids, datum_kwargs), defaults to bulk_insert_datum
+    '''
+    names = list(columns)
+    columns = [np.asarray(columns[name]) for name in names]
+    for start in range(0, len(datum_ids), chunk_size):
+        stop = start + chunk_size
+        # tolist() gives native Python types for the database
+        values = zip(*(column[start:stop].tolist() for column in columns))
+        insert(resource, datum_ids[start:stop],
+               [dict(zip(names, row)) for row in values])
@@ -1,18 +1,23 @@
 # Since the hxntools.detectors.xspress3 module is now shared with srx, breaking
 # out the truly hxn-specific stuff here
 from collections import OrderedDict
-import uuid
-import itertools
 import logging
+import threading
 import time
+import uuid
+
+import numpy as np
 
 from ophyd import (Component as Cpt, Signal)
 from ophyd.status import DeviceStatus
 from ophyd.device import (BlueskyInterface, Staged)
 from ophyd.utils import set_and_wait
 
-from filestore.api import bulk_insert_datum
+from ..handlers import Xspress3HDF5Handler
+from ..timing import (get_tracer, traced_method)
+from .datum_writer import (columnar_datum_ids, bulk_insert_datum_columns)
 from .xspress3 import (XspressTrigger, Xspress3Detector, Xspress3FileStore)
+from .staging import ConcurrentStageMixin
 from .trigger_mixins import HxnModalBase
 
 
@@ -26,6 +31,7 @@ class HxnXspressTrigger(HxnModalBase, BlueskyInterface):
         self._acquisition_signal = self.settings.acquire
         self._abs_trigger_count = 0
 
+    @traced_method('stage')
     def unstage(self):
         ret = super().unstage()
         try:
@@ -64,11 +70,13 @@ class HxnXspressTrigger(HxnModalBase, BlueskyInterface):
     def _dispatch_channels(self, trigger_time):
         self._abs_trigger_count += 1
         channels = self._channels.values()
-        for sn in self.read_attrs:
-            ch = getattr(self, sn)
-            if ch in channels:
-                self.dispatch(ch.name, trigger_time)
+        with get_tracer().span('{}.dispatch'.format(self.name), 'dispatch'):
+            for sn in self.read_attrs:
+                ch = getattr(self, sn)
+                if ch in channels:
+                    self.dispatch(ch.name, trigger_time)
 
+    @traced_method('trigger')
     def trigger_internal(self):
         if self._staged != Staged.yes:
             raise RuntimeError("not staged")
@@ -78,6 +86,7 @@ class HxnXspressTrigger(HxnModalBase, BlueskyInterface):
         self._dispatch_channels(trigger_time=time.time())
         return self._status
 
+    @traced_method('trigger')
     def trigger_external(self):
         if self._staged != Staged.yes:
             raise RuntimeError("not staged")
@@ -90,6 +99,7 @@ class HxnXspressTrigger(HxnModalBase, BlueskyInterface):
 
         return self._status
 
+    @traced_method('stage')
     def stage(self):
         staged = super().stage()
         mode = self.mode_settings.mode.get()
@@ -101,8 +111,172 @@ class HxnXspressTrigger(HxnModalBase, BlueskyInterface):
         return staged
 
 
-class HxnXspress3DetectorBase(HxnXspressTrigger, Xspress3Detector):
+class RoiStream(object):
+    '''Compute ROI sums in the background while a file is being written
+
+    Follows the file in SWMR mode, summing the ROIs over each batch of at
+    least `batch_frames` new frames (e.g., one fly line) as it arrives.
+
+    Parameters
+    ----------
+    filename : str
+        HDF5 filename being written
+    key : str
+        Dataset path
+    rois : sequence of Xspress3ROI
+    bins : sequence of (bin_low, bin_high)
+        Bin window of each ROI
+    total_points : int
+        Number of frames in the scan
+    batch_frames : int, optional
+        Minimum number of new frames per batch
+    callback : callable, optional
+        Called as callback(first=first, rois={name: new_values}) per batch
+    poll_interval : float, optional
+        Seconds between checks for new frames
+    '''
+    def __init__(self, filename, key, rois, bins, total_points, *,
+                 batch_frames=1, callback=None, poll_interval=0.5):
+        self.filename = filename
+        self.key = key
+        self.rois = list(rois)
+        self.bins = list(bins)
+        self.total_points = total_points
+        self.batch_frames = max(int(batch_frames), 1)
+        self.callback = callback
+        self.poll_interval = poll_interval
+        self.error = None
+
+        self._frames = 0
+        self._data = [[] for roi in self.rois]
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='roi_stream')
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        '''Stop following the file, keeping the ROI sums so far'''
+        self._stop_event.set()
+        if self._thread.ident is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        # any failure is recorded in self.error, so that fly_collect_rois
+        # falls back to reading the whole file
+        handler = None
+        try:
+            names = [roi.name for roi in self.rois]
+            specs = [(roi.channel_num, bin_low, bin_high)
+                     for roi, (bin_low, bin_high) in zip(self.rois,
+                                                         self.bins)]
+            handler = Xspress3HDF5Handler(self.filename, key=self.key)
+            for first, roi_data in handler.follow_rois(
+                    specs, stop=self.total_points,
+                    min_frames=self.batch_frames,
+                    poll_interval=self.poll_interval,
+                    stop_event=self._stop_event):
+                with self._lock:
+                    for data, new_data in zip(self._data, roi_data):
+                        data.append(new_data)
+                    self._frames = first + len(roi_data[0])
+
+                if self.callback is not None:
+                    self.callback(first=first,
+                                  rois=OrderedDict(zip(names, roi_data)))
+        except Exception as ex:
+            logger.exception('ROI streaming of %s failed', self.filename)
+            self.error = ex
+        finally:
+            if handler is not None:
+                handler.close()
+
+    def get(self):
+        '''The number of frames summed and the ROI sums so far'''
+        with self._lock:
+            return self._frames, [np.concatenate(data) if data
+                                  else np.zeros(0)
+                                  for data in self._data]
+
+
+class HxnXspress3DetectorBase(HxnXspressTrigger, Xspress3Detector,
+                              ConcurrentStageMixin):
+    # subscribe to receive ROI sums while fly scanning with stream_rois
+    SUB_ROI_BATCH = 'roi_batch'
+
     flyer_timestamps = Cpt(Signal)
+    stream_rois = Cpt(Signal, value=False,
+                      doc='Compute ROIs per batch of frames while fly '
+                          'scanning')
+    stream_batch_frames = Cpt(Signal, value=1,
+                              doc='Frames per streamed ROI batch (e.g., the '
+                                  'number of points per fly line)')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._roi_stream = None
+
+    @property
+    def _streaming(self):
+        return (self.mode == 'external' and
+                self.mode_settings.scan_type.get() == 'fly' and
+                bool(self.stream_rois.get()))
+
+    def mode_internal(self):
+        super().mode_internal()
+        self._stage_swmr_mode(False)
+
+    def mode_external(self):
+        super().mode_external()
+        # streaming reads the file while it is written, which needs SWMR
+        self._stage_swmr_mode(self._streaming)
+
+    def _stage_swmr_mode(self, enable):
+        '''Add or remove SWMR writing in the hdf5 plugin stage_sigs'''
+        swmr_mode = getattr(self.hdf5, 'swmr_mode', None)
+        if swmr_mode is None:
+            return
+
+        if enable:
+            self.hdf5.stage_sigs[swmr_mode] = 1
+        else:
+            self.hdf5.stage_sigs.pop(swmr_mode, None)
+
+    @traced_method('stage')
+    def stage(self):
+        self._roi_stream = None
+        staged = super().stage()
+        if self._streaming:
+            self._start_roi_stream()
+        return staged
+
+    @traced_method('stage')
+    def unstage(self):
+        # ROI sums streamed so far are kept for fly_collect_rois
+        if self._roi_stream is not None:
+            self._roi_stream.stop()
+        return super().unstage()
+
+    def _start_roi_stream(self):
+        rois = list(self.enabled_rois)
+        if not rois:
+            return
+
+        bins = [(bin_low, bin_high) for bin_low, bin_high, enable
+                in self._roi_settings(rois)]
+
+        def roi_batch(first, rois):
+            self._run_subs(sub_type=self.SUB_ROI_BATCH, first=first,
+                           rois=rois)
+
+        self._roi_stream = RoiStream(
+            self.hdf5._fn, self.data_key, rois, bins,
+            self.settings.num_images.get(),
+            batch_frames=self.stream_batch_frames.get(),
+            callback=roi_batch)
+        self._roi_stream.start()
 
     @property
     def hdf5_filename(self):
@@ -116,6 +290,7 @@ class HxnXspress3DetectorBase(HxnXspressTrigger, Xspress3Detector):
 
         return [desc]
 
+    @traced_method('bulk_read')
     def bulk_read(self, timestamps=None):
         # TODO not compatible with collect() just yet due to the values
         #      returned
@@ -126,32 +301,52 @@ class HxnXspress3DetectorBase(HxnXspressTrigger, Xspress3Detector):
         if timestamps is None:
             raise ValueError('Timestamps must be set first')
 
-        channels = self.channels
-        ch_uids = {ch: [str(uuid.uuid4()) for ts in timestamps]
-                   for ch in channels}
-
         count = len(timestamps)
         if count == 0:
             return {}
 
-        def get_datum_args():
-            for ch in channels:
-                for seq_num in range(count):
-                    yield {'frame': seq_num,
-                           'channel': ch}
-
-        uids = [ch_uids[ch] for ch in channels]
-        bulk_insert_datum(fs_res, itertools.chain(*uids),
-                          get_datum_args())
-        return OrderedDict((self.hdf5.mds_keys[ch], ch_uids[ch])
-                           for ch in channels)
+        # datum kwargs are built column-wise from arrays and inserted in
+        # chunks; the call id keeps the ids unique if bulk_read is called
+        # again for the same resource
+        frames = np.arange(count)
+        call_id = str(uuid.uuid4())
+        ch_uids = OrderedDict()
+        for ch in self.channels:
+            uids = columnar_datum_ids(fs_res['id'], ch, range(count),
+                                      call_id=call_id)
+            with get_tracer().span('bulk_insert_datum', 'filestore',
+                                   count=count):
+                bulk_insert_datum_columns(
+                    fs_res, uids, {'frame': frames,
+                                   'channel': np.full(count, ch, dtype=int)})
+            ch_uids[ch] = uids
+
+        return OrderedDict((self.hdf5.mds_keys[ch], uids)
+                           for ch, uids in ch_uids.items())
 
     def fly_collect_rois(self):
         # Purposefully try reading the hdf5 file *AFTER* inserting the spectra
         # entries to filestore:
         hdf5 = self.hdf5._fn
-        for name, roi_data in self.read_hdf5(hdf5):
-            yield (name, roi_data)
+        stream, self._roi_stream = self._roi_stream, None
+        if stream is not None:
+            stream.stop()
+            if stream.error is not None:
+                logger.warning('ROI streaming failed; reading all frames')
+                stream = None
+
+        if stream is None:
+            for name, roi_data in self.read_hdf5(hdf5):
+                yield (name, roi_data)
+            return
+
+        # only the frames written since the last streamed batch are read
+        start, streamed = stream.get()
+        for (name, roi_data), data in zip(
+                self.read_hdf5(hdf5, rois=stream.rois, start=start),
+                streamed):
+            value = np.concatenate([data, roi_data.value])
+            yield (name, roi_data._replace(value=value))
 
     def stop(self):
         super().stop()
@@ -7,6 +7,7 @@ from ophyd.areadetector.filestore_mixins import (
     FileStoreIterativeWrite, FileStoreTIFF, FileStorePluginBase)
 
 from .utils import (makedirs, make_filename_add_subdirectory)
+from .staging import ConcurrentStageMixin
 from .trigger_mixins import (HxnModalTrigger, FileStoreBulkReadable)
 import filestore.api as fsapi
 
@@ -40,7 +41,8 @@ class MerlinDetector(AreaDetector):
               )
 
 
-class MerlinFileStoreHDF5(FileStorePluginBase, FileStoreBulkReadable):
+class MerlinFileStoreHDF5(FileStorePluginBase, FileStoreBulkReadable,
+                          ConcurrentStageMixin):
     _spec = 'TPX_HDF5'
 
     def __init__(self, *args, **kwargs):
@@ -78,7 +80,8 @@ class HDF5PluginWithFileStore(HDF5Plugin, MerlinFileStoreHDF5):
         return super().stage()
 
 
-class HxnMerlinDetector(HxnModalTrigger, MerlinDetector):
+class HxnMerlinDetector(HxnModalTrigger, MerlinDetector,
+                        ConcurrentStageMixin):
     hdf5 = Cpt(HDF5PluginWithFileStore, 'HDF1:',
                read_attrs=[],
                configuration_attrs=[],
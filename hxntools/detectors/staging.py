@@ -0,0 +1,392 @@
+import functools
+import logging
+import numbers
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from ophyd import Device
+from ophyd.device import Staged
+from ophyd.utils import set_and_wait
+
+
+logger = logging.getLogger(__name__)
+
+# attribute names of signals which must be set in stage_sigs order, after
+# everything before them and before everything after them
+DEFAULT_STAGE_BARRIERS = ('acquire', 'capture', 'erase', 'erase_start',
+                          'stop_all', 'count', 'num_images', 'num_capture')
+# attribute names of command/trigger signals, where a put has an effect even
+# if the value is unchanged
+DEFAULT_STAGE_COMMANDS = ('acquire', 'capture', 'erase', 'erase_start',
+                          'start_all', 'stop_all', 'count', 'trigger',
+                          'reset')
+
+_stage_executor = None
+_stage_executor_lock = threading.Lock()
+
+# stage() only reuses prestages made under the current tag (see
+# stage_devices and release_prestaged)
+_prestage_lock = threading.Lock()
+_prestage_tag = None
+_prestaged_devices = []
+
+
+def get_stage_executor():
+    '''The thread pool used to apply stage signals concurrently'''
+    global _stage_executor
+    with _stage_executor_lock:
+        if _stage_executor is None:
+            _stage_executor = ThreadPoolExecutor(max_workers=16)
+        return _stage_executor
+
+
+def _has_attr_name(signal, names):
+    attr_name = getattr(signal, 'attr_name', None)
+    if attr_name is not None:
+        return attr_name in names
+    return any(signal.name.endswith('_' + name) for name in names)
+
+
+def _enum_value(signal, value):
+    '''value as its enum string, if signal is an enum and value an index'''
+    enum_strs = getattr(signal, 'enum_strs', None)
+    if (enum_strs and isinstance(value, numbers.Integral) and
+            0 <= value < len(enum_strs)):
+        return enum_strs[value]
+    return value
+
+
+def _same_value(signal, a, b):
+    '''Whether a and b are the same value of signal
+
+    Enum signals report their index from get() and monitors while
+    stage_sigs usually hold the string, so both are compared as strings.
+    '''
+    a, b = _enum_value(signal, a), _enum_value(signal, b)
+    try:
+        return bool(a == b)
+    except (TypeError, ValueError):
+        # e.g., comparing arrays
+        return False
+
+
+class ConcurrentStageMixin(Device):
+    '''Apply stage_sigs concurrently, keeping barrier signals ordered
+
+    Signals named in `stage_barriers` (e.g., acquire, capture) act as
+    barriers: everything listed before one in stage_sigs is set first, then
+    the barrier alone, then the signals after it.  Signals between two
+    barriers are set concurrently.
+
+    With `cache_stage_values` set, each stage signal is monitored once
+    staged so that its live value is known without a get: the next stage
+    only writes setting signals whose value differs, and unstage only
+    restores those which were changed.  Barriers and the command signals
+    named in `stage_commands` (e.g., erase, stop_all) are always put, as
+    writing them acts even without a change of value.  It is off by
+    default; set it per class or device, or for all devices with the
+    `cache_stage_values` option of `hxntools.scans.setup`.
+
+    The mixin should be the last base class, so that it wraps only the
+    application of stage_sigs and staging of the sub-devices; those stage
+    themselves as usual, so sub-devices without the mixin (e.g., a cam)
+    still apply their stage_sigs serially.  Timings of the last stage are
+    kept in `stage_timings`.
+    '''
+    stage_barriers = DEFAULT_STAGE_BARRIERS
+    stage_commands = DEFAULT_STAGE_COMMANDS
+    cache_stage_values = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stage_timings = OrderedDict()
+        self._prestaged = None
+        self._stage_values = {}
+        self._stage_monitors = {}
+        self._stage_values_lock = threading.Lock()
+
+    def _stage_value_changed(self, signal, value=None, **kwargs):
+        with self._stage_values_lock:
+            self._stage_values[signal] = value
+
+    def _known_value(self, signal, default=None):
+        '''Last value of signal reported by its monitor, if connected'''
+        if not getattr(signal, 'connected', True):
+            return default
+
+        with self._stage_values_lock:
+            return self._stage_values.get(signal, default)
+
+    def _monitor_stage_signal(self, signal, value):
+        '''Record the value just set, and monitor the signal from now on'''
+        with self._stage_values_lock:
+            self._stage_values[signal] = value
+            if signal in self._stage_monitors:
+                return
+            callback = functools.partial(self._stage_value_changed, signal)
+            self._stage_monitors[signal] = callback
+
+        signal.subscribe(callback, run=False)
+
+    def clear_stage_cache(self):
+        '''Forget the cached stage signal values and stop monitoring'''
+        with self._stage_values_lock:
+            monitors, self._stage_monitors = self._stage_monitors, {}
+            self._stage_values.clear()
+
+        for signal, callback in monitors.items():
+            try:
+                signal.clear_sub(callback)
+            except KeyError:
+                pass
+
+    def _always_put(self, signal):
+        '''Whether signal must be written even if already at the value'''
+        return (_has_attr_name(signal, self.stage_barriers) or
+                _has_attr_name(signal, self.stage_commands))
+
+    def _stage_groups(self):
+        '''Split stage_sigs into groups which can be set concurrently'''
+        groups = []
+        group = []
+        for signal, value in self.stage_sigs.items():
+            if isinstance(signal, str):
+                signal = getattr(self, signal)
+
+            if _has_attr_name(signal, self.stage_barriers):
+                if group:
+                    groups.append(group)
+                groups.append([(signal, value)])
+                group = []
+            else:
+                group.append((signal, value))
+
+        if group:
+            groups.append(group)
+        return groups
+
+    def _apply_stage_group(self, group):
+        '''Set a group of signals, returning their original values'''
+        missing = object()
+
+        def set_signal(signal, value):
+            original = missing
+            if self.cache_stage_values:
+                original = self._known_value(signal, missing)
+            if original is missing:
+                original = signal.get()
+
+            if (self.cache_stage_values and not self._always_put(signal) and
+                    _same_value(signal, original, value)):
+                # already set; nothing to write
+                self._monitor_stage_signal(signal, original)
+                return original
+
+            set_and_wait(signal, value)
+            if self.cache_stage_values:
+                self._monitor_stage_signal(signal, value)
+            return original
+
+        if len(group) == 1:
+            (signal, value), = group
+            return [(signal, set_signal(signal, value))]
+
+        executor = get_stage_executor()
+        futures = [(signal, executor.submit(set_signal, signal, value))
+                   for signal, value in group]
+
+        originals = []
+        error = None
+        for signal, future in futures:
+            try:
+                originals.append((signal, future.result()))
+            except Exception as ex:
+                logger.error('%s: failed to stage %s', self.name,
+                             signal.name, exc_info=ex)
+                if error is None:
+                    error = ex
+
+        if error is not None:
+            # record what was set so unstage can restore it
+            for signal, original in originals:
+                self._original_vals[signal] = original
+            raise error
+        return originals
+
+    def stage(self):
+        if self._prestaged is not None:
+            # staged by stage_devices() ahead of time
+            (tag, staged), self._prestaged = self._prestaged, None
+            with _prestage_lock:
+                current = tag is _prestage_tag
+            if current:
+                return staged
+
+            logger.warning('%s: discarding staging left over from an '
+                           'earlier scan', self.name)
+            self.unstage()
+
+        if self._staged == Staged.yes:
+            return super().stage()
+
+        t0 = time.perf_counter()
+        try:
+            for group in self._stage_groups():
+                for signal, original in self._apply_stage_group(group):
+                    self._original_vals[signal] = original
+        except Exception:
+            self.unstage()
+            raise
+
+        t1 = time.perf_counter()
+
+        # the signals are set; let the base class stage the sub-devices
+        stage_sigs, self.stage_sigs = self.stage_sigs, OrderedDict()
+        try:
+            staged = super().stage()
+        finally:
+            self.stage_sigs = stage_sigs
+
+        t2 = time.perf_counter()
+        self.stage_timings = OrderedDict([('stage_sigs', t1 - t0),
+                                          ('sub_devices', t2 - t1),
+                                          ('total', t2 - t0)])
+        logger.debug('%s staged in %.3f s (stage_sigs %.3f s)', self.name,
+                     t2 - t0, t1 - t0)
+        return staged
+
+    def unstage(self):
+        if self.cache_stage_values:
+            missing = object()
+            # signals already at their original value need no restore
+            for signal, original in list(self._original_vals.items()):
+                if self._always_put(signal):
+                    continue
+                if _same_value(signal, self._known_value(signal, missing),
+                               original):
+                    del self._original_vals[signal]
+
+        return super().unstage()
+
+
+def stage_devices(devices, *, first=None, max_workers=None, tag=None):
+    '''Stage several devices concurrently, ahead of the RunEngine
+
+    Applies the stage_sigs of each ConcurrentStageMixin device and stages
+    its sub-devices; the device's own stage() overrides run when the
+    RunEngine later stages it, at which point the staging done here is
+    reused.  Mode setup should already have been done.
+
+    Devices prestaged by an earlier call and not used since are unstaged
+    first.  stage() only reuses a prestage while `tag` is current, i.e.
+    until the next stage_devices or release_prestaged call; the caller
+    must call release_prestaged once the scan ends, however it ends.
+
+    Parameters
+    ----------
+    devices : iterable of ConcurrentStageMixin
+    first : iterable of ConcurrentStageMixin, optional
+        Those of `devices` which must be staged before the others are
+        started, e.g. externally triggered detectors ahead of the devices
+        triggering them
+    max_workers : int, optional
+        Devices staged at once, defaults to all of them
+    tag : object, optional
+        Identifies the scan the devices are staged for (e.g., its scan ID
+        reservation), defaults to a new object
+
+    Returns
+    -------
+    timings : OrderedDict
+        {device name: seconds taken to stage}
+    '''
+    global _prestage_tag
+    devices = list(devices)
+    for device in devices:
+        if not isinstance(device, ConcurrentStageMixin):
+            raise TypeError('{} does not support concurrent staging'
+                            ''.format(device.name))
+
+    # staged before but never used (e.g., the scan failed early)
+    release_prestaged()
+    if tag is None:
+        tag = object()
+
+    first = set(first or ())
+    phases = [[device for device in devices if device in first],
+              [device for device in devices if device not in first]]
+    phases = [phase for phase in phases if phase]
+
+    def stage(device):
+        t0 = time.perf_counter()
+        staged = ConcurrentStageMixin.stage(device)
+        return staged, time.perf_counter() - t0
+
+    timings = OrderedDict()
+    errors = []
+    with _prestage_lock:
+        _prestage_tag = tag
+
+    for phase in phases:
+        workers = min(max_workers or len(phase), len(phase))
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            futures = [(device, ex.submit(stage, device))
+                       for device in phase]
+
+        for device, future in futures:
+            try:
+                staged, elapsed = future.result()
+            except Exception as ex:
+                errors.append((device, ex))
+            else:
+                device._prestaged = (tag, staged)
+                with _prestage_lock:
+                    _prestaged_devices.append(device)
+                timings[device.name] = elapsed
+
+        if errors:
+            break
+
+    if errors:
+        release_prestaged()
+        device, ex = errors[0]
+        raise RuntimeError('Failed to stage {}'.format(device.name)) from ex
+
+    logger.debug('Staged %s', ', '.join('{} ({:.3f} s)'.format(name, t)
+                                         for name, t in timings.items()))
+    return timings
+
+
+def release_prestaged():
+    '''Unstage the devices staged by stage_devices and not used since
+
+    Also ends the current prestage: stage() no longer reuses it.
+
+    Returns
+    -------
+    devices : list
+        The devices which were unstaged
+    '''
+    global _prestage_tag
+    with _prestage_lock:
+        devices = list(_prestaged_devices)
+        del _prestaged_devices[:]
+        _prestage_tag = None
+
+    released = []
+    for device in devices:
+        if device._prestaged is None:
+            # used by the RunEngine's stage()
+            continue
+
+        logger.debug('Unstaging unused prestaged device %s', device.name)
+        device._prestaged = None
+        try:
+            device.unstage()
+        except Exception as ex:
+            logger.error('Failed to unstage %s', device.name, exc_info=ex)
+        else:
+            released.append(device)
+    return released
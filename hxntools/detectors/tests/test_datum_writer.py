@@ -0,0 +1,68 @@
+'''Write-behind datum insertion with a fake insert function'''
+import threading
+import time
+
+import pytest
+
+from hxntools.detectors.datum_writer import (WriteBehindDatumWriter,
+                                             DatumWriterError)
+
+
+class FakeInsert(object):
+    '''Records the batches inserted; blocks until `release` is set'''
+    def __init__(self, blocking=False):
+        self.batches = []
+        self.release = threading.Event()
+        if not blocking:
+            self.release.set()
+        self.error = None
+
+    def __call__(self, resource, uids, datum_kwargs):
+        self.release.wait()
+        if self.error is not None:
+            raise self.error
+        self.batches.append(list(uids))
+
+
+def test_batches_until_flush():
+    insert = FakeInsert()
+    writer = WriteBehindDatumWriter({'id': 'res'}, max_batch=100,
+                                    max_latency=60, insert=insert)
+    writer.add(['a', 'b'], [{}, {}])
+    time.sleep(0.1)
+    assert insert.batches == []
+
+    assert writer.flush(timeout=5)
+    assert insert.batches == [['a', 'b']]
+    writer.close()
+
+
+def test_flush_timeout_keeps_batching():
+    insert = FakeInsert(blocking=True)
+    writer = WriteBehindDatumWriter({'id': 'res'}, max_batch=100,
+                                    max_latency=60, insert=insert)
+    writer.add(['a'], [{}])
+    # the insertion is stuck, so the flush times out
+    assert not writer.flush(timeout=0.1)
+    assert not writer._flush_requested
+
+    insert.release.set()
+    writer.add(['b'], [{}])
+    time.sleep(0.2)
+    # 'b' waits for the batch to fill or for max_latency
+    assert insert.batches == [['a']]
+
+    assert writer.flush(timeout=5)
+    assert insert.batches == [['a'], ['b']]
+    writer.close()
+
+
+def test_insert_error_raised():
+    insert = FakeInsert()
+    insert.error = RuntimeError('database down')
+    writer = WriteBehindDatumWriter({'id': 'res'}, max_batch=1,
+                                    max_latency=60, insert=insert)
+    writer.add(['a'], [{}])
+    with pytest.raises(DatumWriterError):
+        writer.flush(timeout=5)
+    writer.close()
@@ -0,0 +1,174 @@
+'''Concurrent and ahead-of-time staging with soft signals'''
+import pytest
+
+from ophyd import (Component as Cpt, Signal)
+from ophyd.device import Staged
+
+from hxntools.detectors import staging
+from hxntools.detectors.staging import (ConcurrentStageMixin, stage_devices,
+                                        release_prestaged)
+
+
+class StagedDevice(ConcurrentStageMixin):
+    setting = Cpt(Signal, value=0)
+    other = Cpt(Signal, value=0)
+
+
+@pytest.fixture(autouse=True)
+def no_prestage():
+    yield
+    release_prestaged()
+
+
+def make_device(name='dev'):
+    dev = StagedDevice(name=name)
+    dev.stage_sigs['setting'] = 5
+    dev.stage_sigs['other'] = 3
+    return dev
+
+
+def test_stage_devices_reused_by_stage():
+    dev = make_device()
+    stage_devices([dev])
+    assert dev.setting.get() == 5
+    assert dev._staged == Staged.yes
+
+    assert dev in dev.stage()
+    assert dev._prestaged is None
+    # consumed by stage(); nothing left to release
+    assert release_prestaged() == []
+
+    dev.unstage()
+    assert dev.setting.get() == 0
+    assert dev.other.get() == 0
+
+
+def test_release_unused_prestage():
+    # e.g., the scan was aborted between hxn_scan_setup and the plan's stage
+    dev = make_device()
+    stage_devices([dev])
+
+    assert release_prestaged() == [dev]
+    assert dev._prestaged is None
+    assert dev._staged == Staged.no
+    assert dev.setting.get() == 0
+    assert dev.other.get() == 0
+
+
+def test_stale_prestage_not_reused():
+    dev = make_device()
+    stage_devices([dev])
+
+    # a later scan, with different settings, starts without the prestage
+    # having been released
+    with staging._prestage_lock:
+        staging._prestage_tag = object()
+    dev.stage_sigs['setting'] = 7
+
+    dev.stage()
+    assert dev.setting.get() == 7
+    dev.unstage()
+    assert dev.setting.get() == 0
+
+
+def test_new_prestage_releases_previous():
+    dev1 = make_device('dev1')
+    dev2 = make_device('dev2')
+    stage_devices([dev1])
+    stage_devices([dev2], tag='scan 2')
+
+    assert dev1._staged == Staged.no
+    assert dev1.setting.get() == 0
+    assert dev2 in dev2.stage()
+    dev2.unstage()
+
+
+def test_hxn_scan_releases_on_failure():
+    scans = pytest.importorskip('hxntools.scans')
+    from bluesky import Msg
+
+    def plan():
+        yield Msg('stage', None)
+        yield Msg('unstage', None)
+
+    gen = scans._hxn_scan(plan(), total_points=1, count_time=1.0)
+    msg = next(gen)
+    while msg.command != 'hxn_commit_scan_id':
+        msg = gen.send(None)
+
+    # the scan ID commit fails (or the user aborts) after the prestage
+    msg = gen.throw(RuntimeError('commit failed'))
+    assert msg.command == 'hxn_release_prestaged'
+    with pytest.raises(RuntimeError):
+        gen.send(None)
+
+
+def test_hxn_scan_releases_on_success():
+    scans = pytest.importorskip('hxntools.scans')
+    from bluesky import Msg
+
+    def plan():
+        yield Msg('stage', None)
+        yield Msg('unstage', None)
+
+    commands = [msg.command for msg in
+                scans._hxn_scan(plan(), total_points=1, count_time=1.0)]
+    assert commands == ['hxn_reserve_scan_id', 'hxn_scan_setup',
+                        'hxn_commit_scan_id', 'stage', 'unstage',
+                        'hxn_release_prestaged']
+
+
+class CountingSignal(Signal):
+    '''Soft signal counting puts; with enum_strs it stores the index, as an
+    EPICS enum reads back'''
+    def __init__(self, *args, enum_strs=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._enum_strs = enum_strs
+        self.puts = 0
+
+    @property
+    def enum_strs(self):
+        return self._enum_strs
+
+    def put(self, value, **kwargs):
+        self.puts += 1
+        if self._enum_strs and isinstance(value, str):
+            value = self._enum_strs.index(value)
+        super().put(value, **kwargs)
+
+
+class CountingDevice(ConcurrentStageMixin):
+    setting = Cpt(CountingSignal, value=5)
+    image_mode = Cpt(CountingSignal, value=1, enum_strs=('Single', 'Multiple'))
+    erase = Cpt(CountingSignal, value=1)
+
+
+def stage_twice(dev):
+    dev.stage_sigs['setting'] = 5
+    dev.stage_sigs['image_mode'] = 'Multiple'
+    dev.stage_sigs['erase'] = 1
+    for i in range(2):
+        dev.stage()
+        dev.unstage()
+
+
+def test_cached_stage_skips_unchanged_settings():
+    dev = CountingDevice(name='dev')
+    dev.cache_stage_values = True
+    stage_twice(dev)
+
+    assert dev.setting.puts == 0
+    # the enum reads back its index, 1, which is 'Multiple'
+    assert dev.image_mode.puts == 0
+    # commands are always written, and restored
+    assert dev.erase.puts == 4
+    dev.clear_stage_cache()
+
+
+def test_uncached_stage_puts_everything():
+    dev = CountingDevice(name='dev')
+    stage_twice(dev)
+
+    assert dev.setting.puts == 4
+    assert dev.image_mode.puts == 4
+    assert dev.erase.puts == 4
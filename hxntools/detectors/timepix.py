@@ -10,6 +10,7 @@ from ophyd import (Device, Component as Cpt, AreaDetector, TIFFPlugin,
 from ophyd import (EpicsSignal, EpicsSignalRO)
 from ophyd.areadetector import (EpicsSignalWithRBV as SignalWithRBV, CamBase)
 from .utils import makedirs
+from .staging import ConcurrentStageMixin
 from .trigger_mixins import (HxnModalTrigger, FileStoreBulkReadable)
 
 
@@ -74,7 +75,7 @@ class TimepixDetectorCam(CamBase):
     tpx_trigger = Cpt(EpicsSignal, 'TPXTrigger')
 
 
-class TimepixDetector(HxnModalTrigger, AreaDetector):
+class TimepixDetector(HxnModalTrigger, AreaDetector, ConcurrentStageMixin):
     _html_docs = []
     cam = Cpt(TimepixDetectorCam, 'cam1:',
               read_attrs=[],
@@ -109,7 +110,8 @@ class TimepixTiffPlugin(TIFFPlugin, FileStoreBulkReadable, FileStoreTIFF,
             return self.parent.cam.num_images.get()
 
 
-class TimepixFileStoreHDF5(FileStorePluginBase, FileStoreIterativeWrite):
+class TimepixFileStoreHDF5(FileStorePluginBase, FileStoreIterativeWrite,
+                           ConcurrentStageMixin):
     _spec = 'TPX_HDF5'
 
     def __init__(self, *args, **kwargs):
@@ -8,6 +8,7 @@ from ophyd import (Signal, )
 from ophyd.areadetector.filestore_mixins import FileStoreBulkWrite
 
 from filestore.api import bulk_insert_datum
+from ..timing import (get_tracer, traced_method)
 from .utils import (ordered_dict_move_to_beginning,
                     make_filename_add_subdirectory)
 
@@ -65,12 +66,18 @@ class HxnModalBase(Device):
         '''Trigger mode (external/internal)'''
         return self.mode_settings.mode.get()
 
+    @traced_method('stage')
     def stage(self):
         if self._staged != Staged.yes:
             self.mode_setup(self.mode)
 
         return super().stage()
 
+    @traced_method('read')
+    def read(self):
+        return super().read()
+
+    @traced_method('stage')
     def unstage(self):
         if self.mode == 'external':
             logger.debug('[Unstage] Stopping externally-triggered detector %s',
@@ -113,6 +120,7 @@ class HxnModalTrigger(HxnModalBase, TriggerBase):
         cam.stage_sigs[cam.image_mode] = 'Multiple'
         cam.stage_sigs[cam.trigger_mode] = 'External'
 
+    @traced_method('stage')
     def stage(self):
         self._acquisition_signal.subscribe(self._acquire_changed)
         staged = super().stage()
@@ -123,6 +131,7 @@ class HxnModalTrigger(HxnModalBase, TriggerBase):
             self._acquisition_signal.put(1, wait=False)
         return staged
 
+    @traced_method('stage')
     def unstage(self):
         try:
             return super().unstage()
@@ -136,7 +145,8 @@ class HxnModalTrigger(HxnModalBase, TriggerBase):
 
         self._status = DeviceStatus(self)
         self._acquisition_signal.put(1, wait=False)
-        self.dispatch(self._image_name, ttime.time())
+        with get_tracer().span('{}.dispatch'.format(self.name), 'dispatch'):
+            self.dispatch(self._image_name, ttime.time())
         return self._status
 
     def trigger_external(self):
@@ -148,10 +158,14 @@ class HxnModalTrigger(HxnModalBase, TriggerBase):
         self._status._finished()
         # TODO this timestamp is inaccurate!
         if self.mode_settings.scan_type.get() != 'fly':
-            # Don't dispatch images for fly-scans - they are bulk read at the end
-            self.dispatch(self._image_name, ttime.time())
+            # Don't dispatch images for fly-scans - they are bulk read at the
+            # end
+            with get_tracer().span('{}.dispatch'.format(self.name),
+                                   'dispatch'):
+                self.dispatch(self._image_name, ttime.time())
         return self._status
 
+    @traced_method('trigger')
     def trigger(self):
         mode_trigger = getattr(self, 'trigger_{}'.format(self.mode))
         return mode_trigger()
@@ -177,13 +191,16 @@ class FileStoreBulkReadable(FileStoreBulkWrite):
         self._datum_kwargs_map.clear()
         self._point_counter = itertools.count()
 
+    @traced_method('bulk_read')
     def bulk_read(self, timestamps):
         image_name = self.image_name
 
         uids = [self.generate_datum(self.image_name, ts) for ts in timestamps]
         datum_args = [self._datum_kwargs_map[uid] for uid in uids]
 
-        bulk_insert_datum(self._resource, uids, datum_args)
+        with get_tracer().span('bulk_insert_datum', 'filestore',
+                               count=len(uids)):
+            bulk_insert_datum(self._resource, uids, datum_args)
 
         # clear so unstage will not save the images twice:
         self._reset_data()
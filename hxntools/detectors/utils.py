@@ -1,5 +1,6 @@
 from __future__ import print_function
 import os
+import threading
 from ophyd import Signal
 
 
@@ -62,3 +63,39 @@ def make_filename_add_subdirectory(fn, read_path, write_path, *,
     if make_directories:
         makedirs(read_path)
     return fn, read_path, write_path
+
+
+def wait_for_value(signal, value, *, timeout=None):
+    '''Wait on a signal's monitor until it reaches a value
+
+    Parameters
+    ----------
+    signal : Signal
+        The signal to watch; its current value is checked first
+    value : object or callable
+        The value to wait for, or a predicate taking the signal value
+    timeout : float, optional
+        Maximum time to wait, in seconds
+
+    Returns
+    -------
+    reached : bool
+        False if the timeout expired first
+    '''
+    if callable(value):
+        predicate = value
+    else:
+        def predicate(current):
+            return current == value
+
+    reached = threading.Event()
+
+    def changed(value=None, **kwargs):
+        if predicate(value):
+            reached.set()
+
+    signal.subscribe(changed, run=True)
+    try:
+        return reached.wait(timeout)
+    finally:
+        signal.clear_sub(changed)
@@ -2,12 +2,17 @@ from __future__ import print_function, division
 import time
 import time as ttime
 import logging
+import functools
 import itertools
+import threading
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 import filestore.api as fs_api
 from filestore.api import bulk_insert_datum
-from .utils import makedirs
+from .utils import (makedirs, wait_for_value)
+from .datum_writer import WriteBehindDatumWriter
+from .staging import ConcurrentStageMixin
 
 from collections import OrderedDict
 
@@ -27,6 +32,7 @@ from ophyd.device import (BlueskyInterface, Staged)
 from ophyd.ophydobj import DeviceStatus
 
 from ..handlers import Xspress3HDF5Handler
+from ..timing import traced_method
 from ..handlers.xspress3 import XRF_DATA_KEY
 
 logger = logging.getLogger(__name__)
@@ -62,14 +68,17 @@ class EvSignal(DerivedSignal):
         return desc
 
 
-class Xspress3FileStore(FileStorePluginBase, HDF5Plugin):
+class Xspress3FileStore(FileStorePluginBase, HDF5Plugin,
+                        ConcurrentStageMixin):
     '''Xspress3 acquisition -> filestore'''
     num_capture_calc = Cpt(EpicsSignal, 'NumCapture_CALC')
     num_capture_calc_disable = Cpt(EpicsSignal, 'NumCapture_CALC.DISA')
 
-    def __init__(self, basename, *, config_time=0.5,
-                 mds_key_format='{self.settings.name}_ch{chan}', parent=None,
-                 **kwargs):
+    def __init__(self, basename, *, config_time=0.0, ready_timeout=5.0,
+                 capture_timeout=15.0, parent=None,
+                 mds_key_format='{self.settings.name}_ch{chan}',
+                 write_behind=False, write_behind_batch=1000,
+                 write_behind_latency=1.0, **kwargs):
         super().__init__(basename, parent=parent, **kwargs)
         det = parent
         self.settings = det.settings
@@ -87,7 +96,20 @@ class Xspress3FileStore(FileStorePluginBase, HDF5Plugin):
         # it was not needed for SRX and I could not guess what it did
         self._master = None
 
+        # config_time: fixed settling time after capture starts (formerly
+        # the only wait, 0.5 s by default; now only needed for IOCs which
+        # report capture before they are ready)
         self._config_time = config_time
+        # maximum time to wait for capture to start (stage) / finish
+        # (unstage), as reported by the IOC
+        self._ready_timeout = ready_timeout
+        self._capture_timeout = capture_timeout
+        # buffer datums and insert them from a background thread, keeping
+        # the filestore round trip out of read()
+        self.write_behind = write_behind
+        self._write_behind_batch = write_behind_batch
+        self._write_behind_latency = write_behind_latency
+        self._datum_writer = None
         self.mds_keys = {chan: mds_key_format.format(self=self, chan=chan)
                          for chan in self.channels}
 
@@ -98,9 +120,13 @@ class Xspress3FileStore(FileStorePluginBase, HDF5Plugin):
     def read(self):
         timestamp = time.time()
         uids = [str(uuid.uuid4()) for ch in self.channels]
+        datum_args = self._get_datum_args(self.parent._abs_trigger_count)
 
-        bulk_insert_datum(self._filestore_res, uids,
-                          self._get_datum_args(self.parent._abs_trigger_count))
+        if self._datum_writer is not None:
+            # raises if an earlier background insertion failed
+            self._datum_writer.add(uids, list(datum_args))
+        else:
+            bulk_insert_datum(self._filestore_res, uids, datum_args)
         # print(self._get_datum_args(self.parent._abs_trigger_count))
 
         return {self.mds_keys[ch]: {'timestamp': timestamp,
@@ -130,24 +156,30 @@ class Xspress3FileStore(FileStorePluginBase, HDF5Plugin):
 
     def unstage(self):
         try:
-            i = 0
             # this needs a fail-safe, RE will now hang forever here
             # as we eat all SIGINT to ensure that cleanup happens in
             # orderly manner.
-            while self.capture.get() == 1:
-                i += 1
-                if (i % 50) == 0:
-                    logger.warning('Still capturing data .... waiting.')
-                time.sleep(0.1)
-                if i > 150:
-                    logger.warning('Still capturing data .... giving up.')
-                    self.capture.put(0)
-                    break
-
+            if not wait_for_value(self.capture, 0,
+                                  timeout=self._capture_timeout):
+                logger.warning('Still capturing data (%s of %s frames) '
+                               '.... giving up.', self.num_captured.get(),
+                               self.num_capture.get())
+                self.capture.put(0)
         except KeyboardInterrupt:
             logger.warning('Still capturing data .... interrupted.')
 
-        return super().unstage()
+        try:
+            self._close_datum_writer()
+        finally:
+            ret = super().unstage()
+        return ret
+
+    def _close_datum_writer(self):
+        '''Flush any buffered datums, raising if an insertion failed'''
+        writer, self._datum_writer = self._datum_writer, None
+        if writer is not None:
+            logger.debug('Flushing buffered datums')
+            writer.close()
 
     def stage(self):
         # if should external trigger
@@ -213,15 +245,56 @@ class Xspress3FileStore(FileStorePluginBase, HDF5Plugin):
         self._filestore_res = fs_api.insert_resource(
             Xspress3HDF5Handler.HANDLER_NAME, self._fn, {})
 
+        if self.write_behind:
+            self._datum_writer = WriteBehindDatumWriter(
+                self._filestore_res, max_batch=self._write_behind_batch,
+                max_latency=self._write_behind_latency)
+
+        # the write status is only updated by the next file operation, so an
+        # error left over from a previous file must not fail this one
+        previous_status = self._get_write_status()
+
         # this gets auto turned off at the end
         self.capture.put(1)
 
-        # Xspress3 needs a bit of time to configure itself...
-        # this does not play nice with the event loop :/
-        time.sleep(self._config_time)
+        # Xspress3 needs a bit of time to configure itself; the capture
+        # readback goes high once the file writer is ready
+        if not wait_for_value(self.capture, 1, timeout=self._ready_timeout):
+            logger.warning('Capture not started after %s s; continuing',
+                           self._ready_timeout)
+        if self._config_time:
+            time.sleep(self._config_time)
+
+        try:
+            self._check_write_status(previous_status)
+        except IOError:
+            # do not leave the plugin capturing with stage_sigs applied
+            self.capture.put(0)
+            self.unstage()
+            raise
 
         return ret
 
+    def _get_write_status(self):
+        '''The file writer (status, message)'''
+        return self.write_status.get(), self.write_message.get()
+
+    def _check_write_status(self, previous_status=None):
+        '''Raise IOError if the file writer reports a new error
+
+        An error identical to `previous_status` (the status before capture
+        started) is stale and only logged.
+        '''
+        status, message = self._get_write_status()
+        if status in (0, 'Write OK'):
+            return
+
+        if (status, message) == previous_status:
+            logger.warning('Ignoring stale file writer error: %s', message)
+            return
+
+        raise IOError('Xspress3 file writer error: {}'.format(message))
+
     def configure(self, total_points=0, master=None, external_trig=False,
                   **kwargs):
         raise NotImplementedError()
@@ -380,27 +453,56 @@ class Xspress3ROI(Device):
         ev_high : int
             high electron volts for ROI
         '''
-        ev_low = int(ev_low)
-        ev_high = int(ev_high)
-
-        enable = 1 if ev_high > ev_low else 0
-        changed = any([self.ev_high.get() != ev_high,
-                       self.ev_low.get() != ev_low,
-                       self.enable.get() != enable])
-
-        if not changed:
+        puts = self._configure_puts(ev_low, ev_high, self.get_roi_state())
+        if not puts:
             return
 
         logger.debug('Setting up EPICS ROI: name=%s ev=(%s, %s) '
-                     'enable=%s prefix=%s channel=%s',
-                     self.name, ev_low, ev_high, enable, self.prefix,
-                     self._channel)
-        if ev_high <= self.ev_low.get():
-            self.ev_low.put(0)
+                     'prefix=%s channel=%s', self.name, ev_low, ev_high,
+                     self.prefix, self._channel)
+        for signal, value in puts:
+            signal.put(value)
+
+    def get_roi_state(self):
+        '''The current (ev_low, ev_high, enable) settings of the ROI'''
+        return (self.ev_low.get(), self.ev_high.get(), self.enable.get())
+
+    def _configure_puts(self, ev_low, ev_high, current):
+        '''The puts needed to change the ROI from its current state
+
+        Parameters
+        ----------
+        ev_low : int
+            low electron volts for ROI
+        ev_high : int
+            high electron volts for ROI
+        current : tuple
+            The current (ev_low, ev_high, enable) settings
 
-        self.ev_high.put(ev_high)
-        self.ev_low.put(ev_low)
-        self.enable.put(enable)
+        Returns
+        -------
+        puts : list of (signal, value)
+            To be applied in order
+        '''
+        # compare at the resolution the IOC stores
+        ev_low = bin_to_ev(ev_to_bin(int(ev_low)))
+        ev_high = bin_to_ev(ev_to_bin(int(ev_high)))
+        enable = 1 if ev_high > ev_low else 0
+
+        cur_low, cur_high, cur_enable = current
+        puts = []
+        if ev_high <= cur_low and cur_low != 0:
+            # the IOC rejects a high limit below the low one
+            puts.append((self.ev_low, 0))
+            cur_low = 0
+
+        if ev_high != cur_high:
+            puts.append((self.ev_high, ev_high))
+        if ev_low != cur_low:
+            puts.append((self.ev_low, ev_low))
+        if enable != cur_enable:
+            puts.append((self.enable, enable))
+        return puts
 
 
 def make_rois(rois):
@@ -442,6 +544,14 @@ class Xspress3Channel(Device):
         for roi in range(1, self.rois.num_rois.get() + 1):
             yield getattr(self.rois, 'roi{:02d}'.format(roi))
 
+    def get_roi(self, index):
+        '''The Xspress3ROI with the given index, starting from 1'''
+        if index <= 0:
+            raise ValueError('ROI index starts from 1')
+        if index > self.rois.num_rois.get():
+            raise ValueError('ROI index {} out of range'.format(index))
+        return getattr(self.rois, 'roi{:02d}'.format(index))
+
     def set_roi(self, index, ev_low, ev_high, *, name=None):
         '''Set specified ROI to (ev_low, ev_high)
 
@@ -461,17 +571,19 @@ class Xspress3Channel(Device):
         if isinstance(index, Xspress3ROI):
             roi = index
         else:
-            if index <= 0:
-                raise ValueError('ROI index starts from 1')
-            roi = list(self.all_rois)[index - 1]
+            roi = self.get_roi(index)
 
         roi.configure(ev_low, ev_high)
         if name is not None:
-            roi_name = self.roi_name_format.format(self=self, roi_name=name)
-            roi.name = roi_name
-            roi.value.name = roi_name
-            roi.value_sum.name = self.roi_sum_name_format.format(self=self,
-                                                                 roi_name=name)
+            self.set_roi_name(roi, name)
+
+    def set_roi_name(self, roi, name):
+        '''Name the ROI and its value signals using the name formats'''
+        roi_name = self.roi_name_format.format(self=self, roi_name=name)
+        roi.name = roi_name
+        roi.value.name = roi_name
+        roi.value_sum.name = self.roi_sum_name_format.format(self=self,
+                                                             roi_name=name)
 
     def clear_all_rois(self):
         '''Clear all ROIs'''
@@ -479,6 +591,84 @@ class Xspress3Channel(Device):
             roi.clear()
 
 
+class RoiStateCache(object):
+    '''ROI settings kept up to date by Channel Access monitors
+
+    Holds (bin_low, bin_high, enable) for each ROI, updated from
+    subscriptions rather than fetched with a get per lookup.
+
+    Parameters
+    ----------
+    rois : iterable of Xspress3ROI
+    '''
+    attrs = ('bin_low', 'bin_high', 'enable')
+
+    def __init__(self, rois):
+        self._rois = list(rois)
+        self._lock = threading.Lock()
+        self._state = {roi: dict.fromkeys(self.attrs) for roi in self._rois}
+        self._subscriptions = []
+        self.last_update = None
+
+    @property
+    def running(self):
+        '''Whether the monitors are subscribed'''
+        return bool(self._subscriptions)
+
+    def start(self):
+        '''Subscribe to the ROI signals'''
+        if self.running:
+            return
+
+        for roi in self._rois:
+            for attr in self.attrs:
+                signal = getattr(roi, attr)
+                callback = functools.partial(self._update, roi, attr)
+                signal.subscribe(callback, run=True)
+                self._subscriptions.append((signal, callback))
+
+    def stop(self):
+        '''Unsubscribe from the ROI signals'''
+        subscriptions, self._subscriptions = self._subscriptions, []
+        for signal, callback in subscriptions:
+            try:
+                signal.clear_sub(callback)
+            except KeyError:
+                pass
+
+    def _update(self, roi, attr, value=None, **kwargs):
+        with self._lock:
+            self._state[roi][attr] = value
+            self.last_update = time.time()
+
+    @property
+    def stale(self):
+        '''True if the cached state cannot be trusted
+
+        This is the case if the monitors are not running, have not yet
+        reported every value, or any signal is disconnected.
+        '''
+        if not self.running:
+            return True
+
+        with self._lock:
+            if any(value is None for state in self._state.values()
+                   for value in state.values()):
+                return True
+
+        return not all(getattr(signal, 'connected', True)
+                       for signal, callback in self._subscriptions)
+
+    def get(self, roi):
+        '''Cached (bin_low, bin_high, enable) of roi
+
+        Raises KeyError for ROIs not in the cache.
+        '''
+        with self._lock:
+            state = self._state[roi]
+            return tuple(state[attr] for attr in self.attrs)
+
+
 class Xspress3Detector(DetectorBase):
     settings = Cpt(Xspress3DetectorSettings, '')
 
@@ -503,6 +693,7 @@ class Xspress3Detector(DetectorBase):
                  channel_prefix=None,
                  roi_sums=False,
                  # to remove?
+                 monitor_rois=True,
                  **kwargs):
 
         if read_attrs is None:
@@ -528,6 +719,10 @@ class Xspress3Detector(DetectorBase):
         # make an ordered dictionary with the channels in order
         self._channels = OrderedDict(sorted(channels.items()))
 
+        # ROI settings from CA monitors, subscribed on first use
+        self._monitor_rois = monitor_rois
+        self._roi_state = None
+
     @property
     def channels(self):
         return self._channels.copy()
@@ -538,13 +733,139 @@ class Xspress3Detector(DetectorBase):
             for roi in channel.all_rois:
                 yield roi
 
+    @property
+    def roi_state(self):
+        '''The monitor-backed RoiStateCache, or None if disabled'''
+        if self._roi_state is None and self._monitor_rois:
+            self._roi_state = RoiStateCache(self.all_rois)
+            self._roi_state.start()
+        return self._roi_state
+
+    def _roi_settings(self, rois):
+        '''(bin_low, bin_high, enable) for each ROI
+
+        Uses the monitor-backed cache unless it is stale.
+        '''
+        rois = list(rois)
+        cache = self.roi_state
+        if cache is not None and not cache.stale:
+            try:
+                return [cache.get(roi) for roi in rois]
+            except KeyError:
+                pass
+
+        return [(roi.bin_low.get(), roi.bin_high.get(), roi.enable.get())
+                for roi in rois]
+
     @property
     def enabled_rois(self):
-        for roi in self.all_rois:
-            if roi.enable.get():
+        rois = list(self.all_rois)
+        for roi, (bin_low, bin_high, enable) in zip(
+                rois, self._roi_settings(rois)):
+            if enable:
                 yield roi
 
-    def read_hdf5(self, fn, *, rois=None, max_retries=2):
+    def configure_rois(self, mapping, *, max_workers=8, timeout=None):
+        '''Configure the ROIs of several channels at once
+
+        The current settings of all listed ROIs are read concurrently, and
+        only the puts needed to reach the requested settings are issued, in
+        parallel across ROIs.  ROIs not in the mapping are left untouched.
+
+        Parameters
+        ----------
+        mapping : dict
+            {channel_num: {roi_index: (ev_low, ev_high[, name])}}
+        max_workers : int, optional
+            Maximum number of concurrent Channel Access operations
+        timeout : float, optional
+            Timeout for the returned status
+
+        Returns
+        -------
+        status : DeviceStatus
+            Finished once all ROIs are configured
+        '''
+        settings = []
+        for chan, rois in mapping.items():
+            try:
+                channel = self._channels[chan]
+            except KeyError:
+                raise ValueError('Unknown channel: {}'.format(chan))
+
+            for index, roi_settings in rois.items():
+                ev_low, ev_high, *name = roi_settings
+                settings.append((channel, channel.get_roi(index), ev_low,
+                                 ev_high, name[0] if name else None))
+
+        status = DeviceStatus(self, timeout=timeout)
+        if not settings:
+            status._finished()
+            return status
+
+        executor = ThreadPoolExecutor(max_workers=min(max_workers,
+                                                      len(settings)))
+        cache = self.roi_state
+        try:
+            if cache is not None and not cache.stale:
+                current = [cache.get(setting[1]) for setting in settings]
+                current = [(bin_to_ev(bin_low), bin_to_ev(bin_high), enable)
+                           for bin_low, bin_high, enable in current]
+            else:
+                current = list(executor.map(
+                    lambda setting: setting[1].get_roi_state(), settings))
+        except Exception:
+            executor.shutdown(wait=False)
+            raise
+
+        chains = []
+        for (channel, roi, ev_low, ev_high, name), state in zip(settings,
+                                                                  current):
+            if name is not None:
+                channel.set_roi_name(roi, name)
+
+            puts = roi._configure_puts(ev_low, ev_high, state)
+            if puts:
+                logger.debug('Setting up EPICS ROI: name=%s ev=(%s, %s)',
+                             roi.name, ev_low, ev_high)
+                chains.append(puts)
+
+        if not chains:
+            executor.shutdown(wait=False)
+            status._finished()
+            return status
+
+        def apply_puts(puts):
+            # puts within one ROI stay ordered
+            for signal, value in puts:
+                signal.put(value, wait=True)
+
+        lock = threading.Lock()
+        remaining = [len(chains)]
+        failures = []
+
+        def chain_done(future):
+            exc = future.exception()
+            if exc is not None:
+                logger.error('Failed to configure ROI', exc_info=exc)
+
+            with lock:
+                if exc is not None:
+                    failures.append(exc)
+                remaining[0] -= 1
+                finished = (remaining[0] == 0)
+
+            if finished:
+                status._finished(success=not failures)
+
+        for puts in chains:
+            executor.submit(apply_puts, puts).add_done_callback(chain_done)
+
+        executor.shutdown(wait=False)
+        return status
+
+    def read_hdf5(self, fn, *, rois=None, max_retries=2, start=0,
+                  roi_cache=None):
         '''Read ROI data from an HDF5 file using the current ROI configuration
 
         Parameters
@@ -552,6 +873,11 @@ class Xspress3Detector(DetectorBase):
         fn : str
             HDF5 filename to load
         rois : sequence of Xspress3ROI instances, optional
+        start : int, optional
+            First frame to read
+        roi_cache : RoiCache or bool, optional
+            Cache of computed ROIs; True for the default on-disk cache
+            (see `hxntools.handlers.roi_cache`), None to always recompute
 
         '''
         if rois is None:
@@ -565,17 +891,24 @@ class Xspress3Detector(DetectorBase):
 
         RoiTuple = Xspress3ROI.get_device_tuple()
 
-        handler = Xspress3HDF5Handler(hdf, key=self.data_key)
-        for roi in self.enabled_rois:
-            roi_data = handler.get_roi(chan=roi.channel_num,
-                                       bin_low=roi.bin_low.get(),
-                                       bin_high=roi.bin_high.get(),
-                                       max_points=num_points)
-
-            roi_info = RoiTuple(bin_low=roi.bin_low.get(),
-                                bin_high=roi.bin_high.get(),
-                                ev_low=roi.ev_low.get(),
-                                ev_high=roi.ev_high.get(),
+        rois = list(rois)
+        bins = [(bin_low, bin_high) for bin_low, bin_high, enable
+                in self._roi_settings(rois)]
+
+        # all ROIs are computed in a single pass over the file
+        handler = Xspress3HDF5Handler(hdf, key=self.data_key,
+                                      roi_cache=roi_cache)
+        all_roi_data = handler.get_rois(
+            [(roi.channel_num, bin_low, bin_high)
+             for roi, (bin_low, bin_high) in zip(rois, bins)],
+            start=start, max_points=max(num_points - start, 0))
+
+        for roi, (bin_low, bin_high), roi_data in zip(rois, bins,
+                                                      all_roi_data):
+            roi_info = RoiTuple(bin_low=bin_low,
+                                bin_high=bin_high,
+                                ev_low=bin_to_ev(bin_low),
+                                ev_high=bin_to_ev(bin_high),
                                 value=roi_data,
                                 value_sum=None,
                                 enable=None)
@@ -618,6 +951,7 @@ class XspressTrigger(BlueskyInterface):
             # Negative-going edge means an acquisition just finished.
             self._status._finished()
 
+    @traced_method('trigger')
     def trigger(self):
         if self._staged != Staged.yes:
             raise RuntimeError("not staged")
@@ -6,6 +6,8 @@ from ophyd import (Device, Component as Cpt, FormattedComponent as FC,
 from ophyd import (EpicsSignal, EpicsSignalRO, DeviceStatus)
 from ophyd.utils import set_and_wait
 
+from ..timing import traced_method
+from .staging import ConcurrentStageMixin
 from .trigger_mixins import HxnModalBase
 
 logger = logging.getLogger(__name__)
@@ -256,7 +258,7 @@ class ZebraGate(Device):
         set_and_wait(self.input2.edge, int(edge2))
 
 
-class Zebra(HxnModalBase, Device):
+class Zebra(HxnModalBase, ConcurrentStageMixin):
     soft_input1 = Cpt(EpicsSignal, 'SOFT_IN:B0')
     soft_input2 = Cpt(EpicsSignal, 'SOFT_IN:B1')
     soft_input3 = Cpt(EpicsSignal, 'SOFT_IN:B2')
@@ -312,6 +314,7 @@ class Zebra(HxnModalBase, Device):
         super().mode_external()
         # handle the scan type here
 
+    @traced_method('trigger')
     def trigger(self):
         # Re-implement this to trigger as desired in bluesky
         status = DeviceStatus(self)
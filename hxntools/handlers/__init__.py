@@ -1,5 +1,6 @@
 from .xspress3 import Xspress3HDF5Handler
 from .timepix import TimepixHDF5Handler
+from .stats import get_read_stats
 
 
 def register():
@@ -0,0 +1,163 @@
+from __future__ import print_function
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import h5py
+
+from .stats import read_stats
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_OPEN = 64
+
+
+class _PoolEntry(object):
+    def __init__(self, key, h5file, stat):
+        self.key = key
+        self.file = h5file
+        self.stat = stat
+        self.refcount = 0
+        self.detached = False
+
+
+def _file_stat(filename):
+    '''Signature used to detect files modified since they were opened'''
+    st = os.stat(filename)
+    return (st.st_mtime_ns, st.st_size)
+
+
+class HDF5FilePool(object):
+    '''Process-wide, reference-counted pool of read-only h5py.File handles
+
+    Handles are shared between all users of the same file (and open keyword
+    arguments), so repeated fills of one scan reuse the open file along with
+    its metadata and chunk caches.  Unreferenced handles stay open until
+    more than `max_open` files are in the pool, at which point the least
+    recently used ones are closed.  A handle whose file changed on disk
+    (mtime or size) is not handed out again; it is closed once its last user
+    releases it.  Files opened with swmr=True are exempt from this check.
+
+    Parameters
+    ----------
+    max_open : int, optional
+        Maximum number of files to keep open.  Files still referenced are
+        never closed, so the limit may be exceeded temporarily.
+    '''
+    def __init__(self, max_open=DEFAULT_MAX_OPEN):
+        self.max_open = max_open
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()
+        self._by_id = {}
+
+    def acquire(self, filename, **open_kwargs):
+        '''Get a shared, open handle for filename
+
+        Every call must be balanced by a call to `release`.
+
+        Parameters
+        ----------
+        filename : str
+            HDF5 filename
+        **open_kwargs
+            Passed to h5py.File; handles are only shared between identical
+            keyword arguments
+        '''
+        key = (os.path.abspath(filename), tuple(sorted(open_kwargs.items())))
+        stat = _file_stat(filename)
+        with self._lock:
+            entry = self._entries.get(key)
+            # files followed in SWMR mode are expected to change
+            swmr = open_kwargs.get('swmr', False)
+            if entry is not None and not swmr and entry.stat != stat:
+                logger.debug('%s changed on disk, reopening', filename)
+                self._detach(entry)
+                entry = None
+
+            if entry is None:
+                self._evict(reserve=1)
+                with read_stats.timed(key[0], 'open'):
+                    h5file = h5py.File(filename, 'r', **open_kwargs)
+                read_stats.add(key[0], opens=1)
+                entry = _PoolEntry(key, h5file, stat)
+                self._entries[key] = entry
+                self._by_id[id(h5file)] = entry
+            else:
+                self._entries.move_to_end(key)
+                read_stats.add(key[0], pool_hits=1)
+
+            entry.refcount += 1
+            return entry.file
+
+    def release(self, h5file):
+        '''Release a handle obtained from `acquire`'''
+        with self._lock:
+            entry = self._by_id.get(id(h5file))
+            if entry is None or entry.file is not h5file:
+                raise ValueError('File not acquired from this pool: {!r}'
+                                 ''.format(h5file))
+
+            entry.refcount -= 1
+            if entry.refcount > 0:
+                return
+
+            if entry.detached:
+                self._close(entry)
+            else:
+                self._evict()
+
+    def _detach(self, entry):
+        '''Stop handing out an entry, closing it if it is unused'''
+        del self._entries[entry.key]
+        entry.detached = True
+        if entry.refcount <= 0:
+            self._close(entry)
+
+    def _close(self, entry):
+        self._by_id.pop(id(entry.file), None)
+        try:
+            entry.file.close()
+        except Exception as ex:
+            logger.warning('Failed to close file', exc_info=ex)
+
+    def _evict(self, reserve=0):
+        '''Close least recently used, unreferenced files over the limit'''
+        excess = len(self._entries) + reserve - self.max_open
+        if excess <= 0:
+            return
+
+        unused = [entry for entry in self._entries.values()
+                  if entry.refcount <= 0]
+        for entry in unused[:excess]:
+            del self._entries[entry.key]
+            self._close(entry)
+
+    def clear(self):
+        '''Close all unreferenced files'''
+        with self._lock:
+            for entry in list(self._entries.values()):
+                if entry.refcount <= 0:
+                    del self._entries[entry.key]
+                    self._close(entry)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return ('{0.__class__.__name__}(max_open={0.max_open}, '
+                'open={1})'.format(self, len(self)))
+
+
+_file_pool = None
+_file_pool_lock = threading.Lock()
+
+
+def get_file_pool():
+    '''The process-wide HDF5FilePool used by the filestore handlers'''
+    global _file_pool
+    with _file_pool_lock:
+        if _file_pool is None:
+            _file_pool = HDF5FilePool()
+        return _file_pool
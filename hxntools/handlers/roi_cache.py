@@ -0,0 +1,172 @@
+from __future__ import print_function
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 1024 ** 3
+ROI_CACHE_ENV = 'HXNTOOLS_ROI_CACHE'
+
+
+def default_cache_directory():
+    '''The ROI cache directory, $HXNTOOLS_ROI_CACHE or ~/.cache/hxntools/roi
+
+    Returns None if the cache was disabled by setting the environment
+    variable to an empty string.
+    '''
+    directory = os.environ.get(ROI_CACHE_ENV)
+    if directory is None:
+        return os.path.join(os.path.expanduser('~'), '.cache', 'hxntools',
+                            'roi')
+    return directory or None
+
+
+class RoiCache(object):
+    '''Persistent on-disk cache of ROI sum vectors
+
+    Entries are keyed by the data file (path, mtime and size), the dataset
+    path, the channel and the bin window, so a rewritten file never returns
+    stale sums.  Once the total size exceeds `max_size`, the least recently
+    used entries are removed.
+
+    Parameters
+    ----------
+    directory : str, optional
+        Where to store the cache, defaults to `default_cache_directory()`
+    max_size : int, optional
+        Maximum total size of the cache in bytes
+    '''
+    def __init__(self, directory=None, *, max_size=DEFAULT_MAX_SIZE):
+        if directory is None:
+            directory = default_cache_directory()
+
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def make_key(filename, dataset_key, chan, bin_low, bin_high):
+        '''Cache key for one ROI of a file
+
+        Raises OSError if the file cannot be accessed.
+        '''
+        filename = os.path.abspath(filename)
+        st = os.stat(filename)
+        return (filename, st.st_mtime_ns, st.st_size, dataset_key,
+                int(chan), int(bin_low), int(bin_high))
+
+    def _path(self, key):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + '.npy')
+
+    def get(self, key):
+        '''The cached ROI sums for key, or None'''
+        path = self._path(key)
+        try:
+            roi = np.load(path, allow_pickle=False)
+        except (OSError, ValueError):
+            return None
+
+        try:
+            # the modification time tracks use, for LRU eviction
+            os.utime(path, None)
+        except OSError:
+            pass
+        return roi
+
+    def put(self, key, roi):
+        '''Store the ROI sums for key'''
+        path = self._path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, np.asarray(roi), allow_pickle=False)
+            os.replace(tmp_path, path)
+        except Exception:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        self._evict()
+
+    def _entries(self):
+        entries = []
+        for fn in os.listdir(self.directory):
+            if not fn.endswith('.npy'):
+                continue
+            path = os.path.join(self.directory, fn)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    @property
+    def size(self):
+        '''Total size of the cache in bytes'''
+        return sum(size for mtime, size, path in self._entries())
+
+    def _evict(self):
+        with self._lock:
+            entries = sorted(self._entries())
+            total = sum(size for mtime, size, path in entries)
+            for mtime, size, path in entries:
+                if total <= self.max_size:
+                    break
+                try:
+                    os.unlink(path)
+                except OSError:
+                    continue
+                total -= size
+
+    def clear(self):
+        '''Remove all cached entries'''
+        with self._lock:
+            for mtime, size, path in self._entries():
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+    def __repr__(self):
+        return ('{0.__class__.__name__}(directory={0.directory!r}, '
+                'max_size={0.max_size})'.format(self))
+
+
+_default_cache = None
+_default_cache_set = False
+_default_cache_lock = threading.Lock()
+
+
+def get_default_roi_cache():
+    '''The RoiCache used by the handlers by default, or None if disabled'''
+    global _default_cache, _default_cache_set
+    with _default_cache_lock:
+        if not _default_cache_set:
+            _default_cache_set = True
+            directory = default_cache_directory()
+            if directory is not None:
+                try:
+                    _default_cache = RoiCache(directory)
+                except OSError as ex:
+                    logger.warning('Unable to create ROI cache in %s; '
+                                   'disabling it', directory, exc_info=ex)
+        return _default_cache
+
+
+def set_default_roi_cache(cache):
+    '''Replace the default RoiCache (None disables caching)'''
+    global _default_cache, _default_cache_set
+    with _default_cache_lock:
+        _default_cache = cache
+        _default_cache_set = True
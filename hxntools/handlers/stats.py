@@ -0,0 +1,139 @@
+from __future__ import print_function
+import json
+import logging
+import os
+import threading
+import time
+from collections import (OrderedDict, defaultdict)
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_FILES = 1000
+COUNTERS = ('bytes_read', 'chunks', 'cache_hits', 'cache_misses',
+            'roi_cache_hits', 'roi_cache_misses', 'opens', 'pool_hits')
+
+
+class ReadStats(object):
+    '''Per-file counters of the work done by the filestore handlers
+
+    Counts bytes read, chunks touched and cache hits/misses, and accumulates
+    wall time per phase (open, read, decompress, index, roi_sum).  Updates
+    are a dictionary increment under a lock; set `enabled` to False to turn
+    them off entirely.
+
+    Only the `max_files` most recently updated files are kept; the counters
+    of older files are dropped.
+    '''
+    def __init__(self, *, enabled=True, max_files=DEFAULT_MAX_FILES):
+        self.enabled = enabled
+        self.max_files = max_files
+        self._lock = threading.Lock()
+        self._counters = defaultdict(lambda: defaultdict(int))
+        self._phases = defaultdict(lambda: defaultdict(lambda: [0, 0.0]))
+        self._recent = OrderedDict()
+
+    def _touch(self, filename):
+        '''Mark filename as recently updated, evicting the oldest files'''
+        self._recent[filename] = None
+        self._recent.move_to_end(filename)
+        while len(self._recent) > self.max_files:
+            evicted, _ = self._recent.popitem(last=False)
+            self._counters.pop(evicted, None)
+            self._phases.pop(evicted, None)
+
+    def add(self, filename, **counts):
+        '''Increment counters for filename, e.g. add(fn, bytes_read=1024)'''
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self._touch(filename)
+            counters = self._counters[filename]
+            for name, value in counts.items():
+                counters[name] += value
+
+    def add_time(self, filename, phase, elapsed):
+        '''Add elapsed seconds spent in phase for filename'''
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self._touch(filename)
+            entry = self._phases[filename][phase]
+            entry[0] += 1
+            entry[1] += elapsed
+
+    @contextmanager
+    def timed(self, filename, phase):
+        '''Context manager adding the time spent in its body to phase'''
+        if not self.enabled:
+            yield
+            return
+
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(filename, phase, time.perf_counter() - t0)
+
+    def snapshot(self, filename=None):
+        '''Current counters, for one file or as {filename: counters}'''
+        with self._lock:
+            filenames = set(self._counters) | set(self._phases)
+            stats = {}
+            for fn in filenames:
+                entry = {name: 0 for name in COUNTERS}
+                entry.update(self._counters.get(fn, {}))
+                entry['phases'] = {
+                    phase: {'count': count, 'time': elapsed}
+                    for phase, (count, elapsed)
+                    in self._phases.get(fn, {}).items()}
+                stats[fn] = entry
+
+        if filename is not None:
+            return stats.get(filename, {})
+        return stats
+
+    def reset(self, filename=None):
+        '''Clear the counters of one file, or of all files'''
+        with self._lock:
+            if filename is None:
+                self._counters.clear()
+                self._phases.clear()
+                self._recent.clear()
+            else:
+                self._counters.pop(filename, None)
+                self._phases.pop(filename, None)
+                self._recent.pop(filename, None)
+
+    def to_json(self, filename=None, **kwargs):
+        '''The snapshot as a JSON string (kwargs are passed to json.dumps)'''
+        return json.dumps(self.snapshot(filename), **kwargs)
+
+    def dump(self, path, filename=None):
+        '''Write the snapshot to a JSON file'''
+        with open(path, 'w') as f:
+            f.write(self.to_json(filename, indent=2, sort_keys=True))
+
+
+read_stats = ReadStats()
+
+
+def get_read_stats():
+    '''The process-wide ReadStats updated by the handlers'''
+    return read_stats
+
+
+def dataset_filename(dataset):
+    '''Filename backing an h5py dataset or np.memmap, if any'''
+    h5file = getattr(dataset, 'file', None)
+    if h5file is not None:
+        filename = h5file.filename
+    else:
+        filename = getattr(dataset, 'filename', None)
+
+    if filename is None:
+        return None
+    return os.path.abspath(filename)
@@ -0,0 +1,160 @@
+'''Follow files written in SWMR mode by a separate writer process'''
+import os
+import subprocess
+import sys
+import textwrap
+
+import h5py
+import numpy as np
+import pytest
+
+from hxntools.handlers.file_pool import get_file_pool
+from hxntools.handlers.timepix import TimepixHDF5Handler
+from hxntools.handlers.xspress3 import (Xspress3HDF5Handler, XRF_DATA_KEY)
+
+
+# frame i of the written dataset is filled with i
+WRITER = textwrap.dedent('''
+    import sys
+    import time
+    import h5py
+    import numpy as np
+
+    filename, key, num_frames = sys.argv[1], sys.argv[2], int(sys.argv[3])
+    frame_shape = tuple(int(dim) for dim in sys.argv[4].split(','))
+    delay = float(sys.argv[5])
+
+    with h5py.File(filename, 'w', libver='latest') as f:
+        ds = f.create_dataset(key, shape=(0, ) + frame_shape,
+                              maxshape=(None, ) + frame_shape,
+                              chunks=(1, ) + frame_shape, dtype='u4')
+        f.swmr_mode = True
+        print('ready', flush=True)
+        sys.stdin.readline()
+
+        for frame in range(num_frames):
+            ds.resize(frame + 1, axis=0)
+            ds[frame] = frame
+            ds.flush()
+            time.sleep(delay)
+''')
+
+
+@pytest.fixture(autouse=True)
+def clear_pool():
+    yield
+    get_file_pool().clear()
+
+
+class Writer(object):
+    def __init__(self, filename, key, num_frames, frame_shape, delay=0.02):
+        self.process = subprocess.Popen(
+            [sys.executable, '-c', WRITER, filename, key, str(num_frames),
+             ','.join(str(dim) for dim in frame_shape), str(delay)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            universal_newlines=True)
+
+    def wait_ready(self):
+        assert self.process.stdout.readline().strip() == 'ready'
+
+    def start(self):
+        self.process.stdin.write('go\n')
+        self.process.stdin.flush()
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        assert self.process.wait(timeout=30) == 0
+
+
+@pytest.mark.parametrize('create_first', [True, False])
+def test_xspress3_follow_rois(tmpdir, create_first):
+    filename = str(tmpdir.join('xsp3.h5'))
+    num_frames, channels, bins = 20, 2, 16
+
+    if not create_first:
+        # the file does not exist yet when the handler is created
+        handler = Xspress3HDF5Handler(filename)
+        assert not os.path.exists(filename)
+
+    writer = Writer(filename, XRF_DATA_KEY, num_frames, (channels, bins))
+    try:
+        writer.wait_ready()
+        if create_first:
+            # the file is open for writing in SWMR mode
+            handler = Xspress3HDF5Handler(filename)
+        writer.start()
+
+        rois = [(1, 0, 4), (2, 2, 10)]
+        batches = list(handler.follow_rois(rois, stop=num_frames,
+                                           min_frames=5, poll_interval=0.01,
+                                           timeout=20))
+    finally:
+        writer.close()
+
+    assert batches[0][0] == 0
+    for roi_idx, (chan, low, high) in enumerate(rois):
+        values = np.concatenate([roi_data[roi_idx]
+                                 for first, roi_data in batches])
+        np.testing.assert_array_equal(values,
+                                      np.arange(num_frames) * (high - low))
+
+    # once written, the regular read path opens the file as usual
+    np.testing.assert_array_equal(handler(frame=3, channel=1),
+                                  np.full(bins, 3))
+    handler.close()
+
+
+def test_timepix_follow(tmpdir):
+    filename = str(tmpdir.join('tpx.h5'))
+    num_frames = 10
+    handler = TimepixHDF5Handler(filename)
+
+    writer = Writer(filename, TimepixHDF5Handler.hardcoded_key, num_frames,
+                    (4, 4))
+    try:
+        writer.wait_ready()
+        writer.start()
+        batches = list(handler.follow(stop=num_frames, poll_interval=0.01,
+                                      timeout=20))
+    finally:
+        writer.close()
+
+    frames = np.concatenate([frames for first, frames in batches])
+    assert frames.shape == (num_frames, 4, 4)
+    np.testing.assert_array_equal(frames[:, 0, 0], np.arange(num_frames))
+    handler.close()
+
+
+def test_closed_handler_raises(tmpdir):
+    filename = str(tmpdir.join('closed.h5'))
+    with h5py.File(filename, 'w') as f:
+        f.create_dataset(XRF_DATA_KEY, data=np.zeros((2, 1, 4)))
+
+    handler = Xspress3HDF5Handler(filename)
+    handler.close()
+    with pytest.raises(ValueError):
+        handler(frame=0, channel=1)
+
+    handler.open()
+    np.testing.assert_array_equal(handler(frame=0, channel=1), np.zeros(4))
+    handler.close()
+
+
+def test_closed_timepix_handler_raises(tmpdir):
+    filename = str(tmpdir.join('closed_tpx.h5'))
+    with h5py.File(filename, 'w') as f:
+        f.create_dataset(TimepixHDF5Handler.hardcoded_key,
+                         data=np.zeros((2, 4, 4)))
+
+    handler = TimepixHDF5Handler(filename)
+    assert not handler._closed
+    handler.close()
+    with pytest.raises(ValueError):
+        handler(0)
+
+    handler.open()
+    np.testing.assert_array_equal(handler(0), np.zeros((4, 4)))
+    handler.close()
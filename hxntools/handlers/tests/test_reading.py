@@ -0,0 +1,196 @@
+'''Block, chunk-cached and parallel reads against plain h5py reads'''
+import h5py
+import numpy as np
+import pytest
+
+from hxntools.handlers.file_pool import get_file_pool
+from hxntools.handlers.timepix import TimepixHDF5Handler
+from hxntools.handlers.utils import (ChunkCachedDataset, can_decompress_chunks,
+                                     read_chunks_parallel, read_dataset)
+from hxntools.handlers.xspress3 import (Xspress3HDF5Handler, XRF_DATA_KEY,
+                                        SUM_CHANNEL)
+
+
+# neither dimension is a multiple of the chunk shape, so the last chunk along
+# every axis is a partial edge chunk
+SHAPE = (23, 3, 37)
+CHUNKS = (4, 2, 16)
+# frames from here on are never written: their chunks stay unallocated
+WRITTEN_FRAMES = 13
+FILL_VALUE = 7
+
+
+@pytest.fixture(autouse=True)
+def clear_pool():
+    yield
+    get_file_pool().clear()
+
+
+def write_dataset(filename, key, shape=SHAPE, chunks=CHUNKS,
+                  compression='gzip'):
+    rs = np.random.RandomState(0)
+    with h5py.File(filename, 'w') as f:
+        ds = f.create_dataset(key, shape=shape, chunks=chunks, dtype='u2',
+                              compression=compression, fillvalue=FILL_VALUE)
+        ds[:WRITTEN_FRAMES] = rs.randint(0, 1000,
+                                         size=(WRITTEN_FRAMES, ) + shape[1:])
+
+    with h5py.File(filename, 'r') as f:
+        return f[key][()]
+
+
+@pytest.fixture
+def xsp3_file(tmpdir):
+    filename = str(tmpdir.join('xsp3.h5'))
+    return filename, write_dataset(filename, XRF_DATA_KEY)
+
+
+SELECTIONS = [
+    (), (slice(None), ), (5, ), (slice(2, 19), slice(1, 3), slice(10, 33)),
+    (slice(11, 15), 1), (slice(20, 23), slice(None), slice(30, 37)),
+    (slice(WRITTEN_FRAMES, None), ), (slice(3, 3), ),
+]
+
+
+@pytest.mark.parametrize('key', SELECTIONS)
+def test_read_chunks_parallel(xsp3_file, key):
+    filename, expected = xsp3_file
+    with h5py.File(filename, 'r') as f:
+        dataset = f[XRF_DATA_KEY]
+        if not can_decompress_chunks(dataset):
+            pytest.skip('h5py cannot read raw chunks')
+        np.testing.assert_array_equal(read_chunks_parallel(dataset, key),
+                                      expected[key])
+        np.testing.assert_array_equal(read_dataset(dataset, key),
+                                      expected[key])
+        np.testing.assert_array_equal(
+            read_dataset(dataset, key, parallel_decompress=False),
+            expected[key])
+
+
+@pytest.mark.parametrize('cache_size', [0, 2 ** 20])
+@pytest.mark.parametrize('key', SELECTIONS)
+def test_chunk_cached_dataset(xsp3_file, key, cache_size):
+    filename, expected = xsp3_file
+    with h5py.File(filename, 'r') as f:
+        cached = ChunkCachedDataset(f[XRF_DATA_KEY], cache_size=cache_size)
+        # the second read is served from the cache, if there is one
+        for _ in range(2):
+            np.testing.assert_array_equal(cached[key], expected[key])
+
+
+def test_chunk_cached_dataset_eviction(xsp3_file):
+    filename, expected = xsp3_file
+    with h5py.File(filename, 'r') as f:
+        dataset = f[XRF_DATA_KEY]
+        chunk_nbytes = int(np.prod(CHUNKS)) * dataset.dtype.itemsize
+        cached = ChunkCachedDataset(dataset, cache_size=2 * chunk_nbytes)
+        for frame in range(SHAPE[0]):
+            np.testing.assert_array_equal(cached[frame], expected[frame])
+            assert cached._cache_bytes <= cached.cache_size
+
+
+@pytest.mark.parametrize('lazy', [True, False])
+@pytest.mark.parametrize('parallel_decompress', [True, False])
+def test_xspress3_get_frames(xsp3_file, lazy, parallel_decompress):
+    filename, expected = xsp3_file
+    handler = Xspress3HDF5Handler(filename, lazy=lazy,
+                                  parallel_decompress=parallel_decompress)
+    # unsorted, duplicated and spanning written and unwritten frames
+    frames = [20, 0, 1, 2, 3, 11, 12, 13, 14, 2, 22]
+    try:
+        np.testing.assert_array_equal(handler.get_frames(frames),
+                                      expected[frames])
+        np.testing.assert_array_equal(
+            handler.get_frames(frames, [3, 1], bin_low=5, bin_high=30),
+            expected[frames][:, [2, 0], 5:30])
+
+        summed = handler.get_frames(frames, sum_channels=True, rebin=4,
+                                    block_size=1)
+        expected_sum = expected[frames].sum(axis=1, keepdims=True,
+                                            dtype='u8')
+        num_bins = SHAPE[2] // 4 * 4
+        expected_sum = expected_sum[..., :num_bins].reshape(
+            len(frames), 1, -1, 4).sum(axis=-1)
+        np.testing.assert_array_equal(summed, expected_sum)
+
+        np.testing.assert_array_equal(handler(frame=17, channel=2),
+                                      expected[17, 1])
+        np.testing.assert_array_equal(
+            handler(frame=4, channel=SUM_CHANNEL),
+            expected[4].sum(axis=0))
+    finally:
+        handler.close()
+
+
+ROI_SETS = [
+    # at most two ROIs per channel: one sum per ROI
+    [(1, 0, 10), (2, 5, 37), (3, 30, 37)],
+    # three or more on one channel: cumulative sum along the bins
+    [(1, 0, 10), (1, 3, 20), (1, 15, 37), (1, 36, 37), (2, 0, 0),
+     (3, 12, 24)],
+    # windows clipped to the bin range
+    [(2, -5, 8), (2, 30, 100), (2, 40, 50)],
+]
+
+
+@pytest.mark.parametrize('rois', ROI_SETS)
+@pytest.mark.parametrize('block_size', [1, 512, 2 ** 20])
+def test_xspress3_get_rois(xsp3_file, rois, block_size):
+    filename, expected = xsp3_file
+    handler = Xspress3HDF5Handler(filename)
+
+    def expected_roi(chan, low, high, start=0, stop=None):
+        low, high = max(low, 0), max(min(high, SHAPE[2]), 0)
+        return expected[start:stop, chan - 1, low:high].sum(axis=1)
+
+    try:
+        results = handler.get_rois(rois, block_size=block_size)
+        assert len(results) == len(rois)
+        for roi, result in zip(rois, results):
+            np.testing.assert_array_equal(result, expected_roi(*roi))
+
+        results = handler.get_rois(rois, start=3, stop=17,
+                                   block_size=block_size)
+        for roi, result in zip(rois, results):
+            np.testing.assert_array_equal(result,
+                                          expected_roi(*roi, start=3,
+                                                       stop=17))
+
+        results = handler.get_rois(rois, max_points=30,
+                                   block_size=block_size)
+        for roi, result in zip(rois, results):
+            padded = np.zeros(30, dtype=result.dtype)
+            padded[:SHAPE[0]] = expected_roi(*roi)
+            np.testing.assert_array_equal(result, padded)
+    finally:
+        handler.close()
+
+
+@pytest.mark.parametrize('compression', ['gzip', None])
+def test_timepix_get_frames(tmpdir, compression):
+    filename = str(tmpdir.join('tpx.h5'))
+    expected = write_dataset(filename, TimepixHDF5Handler.hardcoded_key,
+                             shape=(23, 11, 13), chunks=(4, 8, 8),
+                             compression=compression)
+    handler = TimepixHDF5Handler(filename)
+    try:
+        np.testing.assert_array_equal(handler.get_frames(), expected)
+        np.testing.assert_array_equal(handler.get_frames(5, 19),
+                                      expected[5:19])
+        np.testing.assert_array_equal(
+            handler.get_frames(2, 21, crop=(1, 10, 3, 12)),
+            expected[2:21, 1:10, 3:12])
+
+        binned = handler.get_frames(2, 21, crop=(1, 10, 3, 12), binning=2)
+        cropped = expected[2:21, 1:9, 3:11].astype('u8')
+        np.testing.assert_array_equal(
+            binned, cropped.reshape(19, 4, 2, 4, 2).sum(axis=(2, 4)))
+
+        np.testing.assert_array_equal(handler.sum_frames(10, 16),
+                                      expected[10:16].sum(axis=0))
+        np.testing.assert_array_equal(
+            handler.frame_totals(),
+            expected.reshape(len(expected), -1).sum(axis=1))
+    finally:
+        handler.close()
@@ -0,0 +1,138 @@
+'''On-disk ROI cache: hits, invalidation and eviction'''
+import os
+
+import h5py
+import numpy as np
+import pytest
+
+from hxntools.handlers.file_pool import get_file_pool
+from hxntools.handlers.roi_cache import RoiCache
+from hxntools.handlers.xspress3 import (Xspress3HDF5Handler, XRF_DATA_KEY)
+
+
+ROIS = [(1, 0, 4), (2, 2, 10)]
+
+
+@pytest.fixture(autouse=True)
+def clear_pool():
+    yield
+    get_file_pool().clear()
+
+
+@pytest.fixture
+def cache(tmpdir):
+    return RoiCache(str(tmpdir.join('cache')))
+
+
+def write_file(filename, num_frames, value):
+    # the pool keeps idle files open, which would block rewriting them
+    get_file_pool().clear()
+    with h5py.File(filename, 'w') as f:
+        f.create_dataset(XRF_DATA_KEY, data=np.full((num_frames, 2, 16), value,
+                                                    dtype='u4'))
+
+
+def expected_rois(num_frames, value):
+    return [np.full(num_frames, value * (high - low))
+            for chan, low, high in ROIS]
+
+
+def get_rois(filename, cache, **kwargs):
+    handler = Xspress3HDF5Handler(filename, roi_cache=cache)
+    try:
+        return handler.get_rois(ROIS, **kwargs)
+    finally:
+        handler.close()
+
+
+def assert_rois_equal(results, expected):
+    assert len(results) == len(expected)
+    for result, roi in zip(results, expected):
+        np.testing.assert_array_equal(result, roi)
+
+
+def test_cache_hit(tmpdir, cache, monkeypatch):
+    filename = str(tmpdir.join('xsp3.h5'))
+    write_file(filename, 10, 1)
+
+    assert_rois_equal(get_rois(filename, cache), expected_rois(10, 1))
+    assert len(cache._entries()) == len(ROIS)
+
+    def not_cached(*args, **kwargs):
+        raise AssertionError('ROI was not served from the cache')
+
+    monkeypatch.setattr(Xspress3HDF5Handler, '_rois_from_dataset', not_cached)
+    assert_rois_equal(get_rois(filename, cache), expected_rois(10, 1))
+
+    # cached ROIs are padded like computed ones
+    padded = get_rois(filename, cache, max_points=12)
+    assert_rois_equal(padded, [np.pad(roi, ((0, 2), ), 'constant')
+                               for roi in expected_rois(10, 1)])
+
+    # partial reads bypass the cache
+    with pytest.raises(AssertionError):
+        get_rois(filename, cache, start=2)
+
+
+def test_no_cache_by_default(tmpdir, cache):
+    filename = str(tmpdir.join('xsp3.h5'))
+    write_file(filename, 10, 1)
+
+    handler = Xspress3HDF5Handler(filename)
+    try:
+        assert handler.roi_cache is None
+        assert_rois_equal(handler.get_rois(ROIS), expected_rois(10, 1))
+    finally:
+        handler.close()
+
+
+def test_invalidated_by_size(tmpdir, cache):
+    filename = str(tmpdir.join('xsp3.h5'))
+    write_file(filename, 10, 1)
+    assert_rois_equal(get_rois(filename, cache), expected_rois(10, 1))
+
+    write_file(filename, 20, 2)
+    assert_rois_equal(get_rois(filename, cache), expected_rois(20, 2))
+
+
+def test_invalidated_by_mtime(tmpdir, cache):
+    filename = str(tmpdir.join('xsp3.h5'))
+    write_file(filename, 10, 1)
+    st = os.stat(filename)
+    assert_rois_equal(get_rois(filename, cache), expected_rois(10, 1))
+
+    # same size and (restored) modification time: a stale hit
+    write_file(filename, 10, 3)
+    assert os.stat(filename).st_size == st.st_size
+    os.utime(filename, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert_rois_equal(get_rois(filename, cache), expected_rois(10, 1))
+
+    os.utime(filename, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert_rois_equal(get_rois(filename, cache), expected_rois(10, 3))
+
+
+def test_eviction(tmpdir):
+    cache = RoiCache(str(tmpdir.join('cache')), max_size=10 ** 6)
+    roi = np.arange(1000, dtype='u8')
+    keys = [('file', 0, 0, XRF_DATA_KEY, 1, idx, idx + 1) for idx in range(4)]
+    for idx, key in enumerate(keys):
+        cache.put(key, roi)
+        # make the use order explicit, regardless of timestamp resolution
+        os.utime(cache._path(key), (idx, idx))
+
+    entry_size = os.stat(cache._path(keys[0])).st_size
+    assert cache.size == 4 * entry_size
+
+    # a hit marks the oldest entry as recently used
+    np.testing.assert_array_equal(cache.get(keys[0]), roi)
+
+    cache.max_size = 3 * entry_size
+    cache.put(keys[-1], roi)
+    assert cache.get(keys[1]) is None
+    for key in (keys[0], keys[2], keys[3]):
+        np.testing.assert_array_equal(cache.get(key), roi)
+    assert cache.size <= cache.max_size
+
+    cache.clear()
+    assert cache.size == 0
+    assert cache.get(keys[0]) is None
@@ -1,7 +1,18 @@
+import logging
+
+import numpy as np
+
 from filestore.handlers import HDF5DatasetSliceHandler
+from .utils import (DEFAULT_BLOCK_SIZE, PooledFileMixin, accumulator_dtype,
+                    follow_dataset, frames_per_block, iter_block_ranges,
+                    memmap_dataset, normalize_selection, prefetch_blocks,
+                    read_dataset)
+
 
+logger = logging.getLogger(__name__)
 
-class TimepixHDF5Handler(HDF5DatasetSliceHandler):
+
+class TimepixHDF5Handler(PooledFileMixin, HDF5DatasetSliceHandler):
     """
     Handler for the 'AD_HDF5' spec used by Area Detectors.
     In this spec, the key (i.e., HDF5 dataset path) is always
@@ -12,6 +23,11 @@ class TimepixHDF5Handler(HDF5DatasetSliceHandler):
         path to HDF5 file
     frame_per_point : integer, optional
         number of frames to return as one datum, default 1
+    mmap : bool, optional
+        memory-map the dataset if it is stored contiguous and uncompressed,
+        default True
+    parallel_decompress : bool, optional
+        decompress zlib chunks on a thread pool, default True
     """
     _handler_name = 'TPX_HDF5'
     specs = {_handler_name}
@@ -19,10 +35,218 @@ class TimepixHDF5Handler(HDF5DatasetSliceHandler):
     # TODO this is only different due to the hardcoded key being different?
     hardcoded_key = '/entry/instrument/detector/data'
 
-    def __init__(self, filename, frame_per_point=1):
+    def __init__(self, filename, frame_per_point=1, *, mmap=True,
+                 parallel_decompress=True):
+        self._mmap = mmap
+        self._parallel_decompress = parallel_decompress
+        self._pooled = True
+        self._closed = False
         super().__init__(filename=filename, key=self.hardcoded_key,
                          frame_per_point=frame_per_point)
 
+    def _get_dataset(self):
+        if self._dataset is not None:
+            return self._dataset
+
+        dataset = self._acquire_file()[self._key]
+        if self._mmap:
+            mapped = memmap_dataset(dataset)
+            if mapped is not None:
+                dataset = mapped
+
+        self._dataset = dataset
+        return dataset
+
+    def __call__(self, point_number):
+        # Don't read out the dataset until it is requested for the first time.
+        dataset = self._get_dataset()
+        start = point_number * self._fpp
+        stop = (point_number + 1) * self._fpp
+        return self._read(dataset, slice(start, stop)).squeeze()
+
+    def _read(self, dataset, key):
+        return read_dataset(dataset, key,
+                            parallel_decompress=self._parallel_decompress)
+
+    def get_frames(self, start=0, stop=None, *, crop=None, binning=1):
+        '''Read a range of frames in one go, optionally cropped and binned
+
+        With binning, frames are read through `iter_frames` and binned one
+        block at a time, so memory use scales with the binned output.
+
+        Parameters
+        ----------
+        start : int, optional
+            First frame
+        stop : int, optional
+            Frame after the last, defaults to the end of the dataset
+        crop : (row_start, row_stop, col_start, col_stop), optional
+            Only read this region of each frame
+        binning : int, optional
+            Sum binning x binning pixel blocks (partial edge blocks are
+            dropped)
+        '''
+        dataset = self._get_dataset()
+        if binning == 1:
+            return self._read(dataset, self._frame_key(dataset, start, stop,
+                                                       crop))
+
+        out = None
+        for first, frames in self.iter_frames(start, stop, crop=crop):
+            frames = bin_frames(frames, binning)
+            if out is None:
+                num_frames = self._frame_count(dataset, start, stop)
+                out = np.empty((num_frames, ) + frames.shape[1:],
+                               dtype=frames.dtype)
+            out[first - start:first - start + len(frames)] = frames
+
+        if out is None:
+            # no frames in range; keep the (cropped, binned) frame shape
+            bounds, _ = normalize_selection(
+                self._frame_key(dataset, start, stop, crop), dataset.shape)
+            shape = tuple(high - low for low, high in bounds)
+            out = bin_frames(np.empty(shape, dtype=dataset.dtype), binning)
+        return out
+
+    def sum_frames(self, start=0, stop=None, *, crop=None, binning=1):
+        '''Sum a range of frames into a single image
+
+        Parameters are as in `get_frames`.
+        '''
+        total = None
+        for first, frames in self.iter_frames(start, stop, crop=crop):
+            block_sum = frames.sum(axis=0, dtype=accumulator_dtype(frames))
+            total = block_sum if total is None else total + block_sum
+
+        if total is not None and binning != 1:
+            total = bin_frames(total[np.newaxis], binning)[0]
+        return total
+
+    def frame_totals(self, start=0, stop=None, *, crop=None):
+        '''Per-frame sum of all pixels (or of the pixels in crop)
+
+        Parameters are as in `get_frames`.
+        '''
+        dataset = self._get_dataset()
+        totals = np.zeros(self._frame_count(dataset, start, stop),
+                          dtype=accumulator_dtype(dataset))
+        for first, frames in self.iter_frames(start, stop, crop=crop):
+            flat = frames.reshape(len(frames), -1)
+            totals[first - start:first - start + len(frames)] = flat.sum(
+                axis=1, dtype=totals.dtype)
+        return totals
+
+    @staticmethod
+    def _frame_count(dataset, start, stop):
+        num_frames = dataset.shape[0]
+        stop = num_frames if stop is None else min(stop, num_frames)
+        return max(stop - start, 0)
+
+    @staticmethod
+    def _frame_key(dataset, first, last, crop):
+        '''Index expression for frames [first, last) cropped to crop'''
+        key = (slice(first, last), )
+        if crop is None:
+            return key
+
+        row_start, row_stop, col_start, col_stop = crop
+        return (key + (slice(None), ) * (len(dataset.shape) - 3) +
+                (slice(row_start, row_stop), slice(col_start, col_stop)))
+
+    def iter_frames(self, start=0, stop=None, *, crop=None, block_frames=None,
+                    block_size=DEFAULT_BLOCK_SIZE, prefetch=2):
+        '''Iterate over frames in blocks, reading ahead on a background thread
+
+        While the caller processes one block, the next `prefetch` blocks are
+        read (and decompressed) in the background, overlapping I/O with
+        computation.  At most `prefetch + 2` blocks are held in memory: the
+        one being processed, `prefetch` queued, and one being read.
+
+        Parameters
+        ----------
+        start : int, optional
+            First frame
+        stop : int, optional
+            Frame after the last, defaults to the end of the dataset
+        crop : (row_start, row_stop, col_start, col_stop), optional
+            Only read this region of each frame
+        block_frames : int, optional
+            Frames per block, defaults to about `block_size` bytes per block
+        block_size : int, optional
+            Approximate number of bytes per block
+        prefetch : int, optional
+            Number of blocks to read ahead
+
+        Yields
+        ------
+        first : int
+            Index of the first frame in the block
+        frames : np.ndarray
+            The frames of the block
+        '''
+        dataset = self._get_dataset()
+        num_frames = dataset.shape[0]
+        stop = num_frames if stop is None else min(stop, num_frames)
+        if block_frames is None:
+            frame_shape = list(dataset.shape[1:])
+            if crop is not None:
+                row_start, row_stop, col_start, col_stop = crop
+                frame_shape[-2] = len(range(*slice(row_start, row_stop)
+                                            .indices(frame_shape[-2])))
+                frame_shape[-1] = len(range(*slice(col_start, col_stop)
+                                            .indices(frame_shape[-1])))
+            frame_nbytes = int(np.prod(frame_shape)) * dataset.dtype.itemsize
+            block_frames = frames_per_block(dataset, frame_nbytes, block_size)
+
+        def read_block(first, last):
+            return self._read(dataset, self._frame_key(dataset, first, last,
+                                                       crop))
+
+        ranges = iter_block_ranges(start, stop, block_frames)
+        if not prefetch:
+            for first, last in ranges:
+                yield first, read_block(first, last)
+            return
+
+        for first, frames in prefetch_blocks(read_block, ranges,
+                                             depth=prefetch):
+            yield first, frames
+
+    def follow(self, *, start=0, stop=None, min_frames=1, poll_interval=0.5,
+               timeout=None, stop_event=None):
+        '''Yield frames as they are written, following the file in SWMR mode
+
+        Parameters are as in `hxntools.handlers.utils.follow_dataset`.
+
+        Yields
+        ------
+        first : int
+            Index of the first frame in the batch
+        frames : np.ndarray
+            The newly written frames
+        '''
+        for dataset, first, last in follow_dataset(
+                self._filename, self._key, start=start, stop=stop,
+                min_frames=min_frames, poll_interval=poll_interval,
+                timeout=timeout, stop_event=stop_event):
+            yield first, self._read(dataset, slice(first, last))
+
+
+def bin_frames(frames, binning):
+    '''Sum binning x binning pixel blocks of a stack of frames
+
+    Rows and columns which do not fill a whole block are dropped.
+    '''
+    if binning == 1:
+        return frames
+
+    rows = frames.shape[-2] // binning
+    cols = frames.shape[-1] // binning
+    frames = frames[..., :rows * binning, :cols * binning]
+    binned = frames.reshape(frames.shape[:-2] +
+                            (rows, binning, cols, binning))
+    return binned.sum(axis=(-3, -1), dtype=accumulator_dtype(frames))
+
 
 def register():
     import filestore.api as fs_api
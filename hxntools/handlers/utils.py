@@ -0,0 +1,661 @@
+from __future__ import print_function
+import itertools
+import logging
+import os
+import threading
+import time
+import zlib
+from collections import (OrderedDict, deque)
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from queue import (Queue, Empty, Full)
+
+import numpy as np
+
+from .file_pool import get_file_pool
+from .stats import (read_stats, dataset_filename)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_CACHE_SIZE = 64 * 1024 ** 2
+DEFAULT_BLOCK_SIZE = 64 * 1024 ** 2
+
+
+class ReadWriteLock(object):
+    '''Many concurrent readers or a single exclusive writer
+
+    Readers are preferred, so a reader may safely nest another read section
+    even while a writer is waiting.
+    '''
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+
+    @contextmanager
+    def reading(self):
+        with self._cond:
+            while self._writer:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def writing(self):
+        with self._cond:
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+class PooledFileMixin(object):
+    '''Lazy open and close of a handler's file through the shared file pool
+
+    The file is acquired from the pool on the first read, so that a handler
+    used only to `follow` a file being written never opens it outside of
+    SWMR mode (nor requires it to exist yet).  Files passed in already open
+    (`_pooled` False) are closed rather than returned to the pool.
+
+    Handlers list this before their filestore base class, whose `open` and
+    `close` it replaces, and set `_filename`, `_file`, `_dataset`, `_pooled`
+    and `_closed` in their constructor.
+    '''
+    def open(self):
+        '''Allow reads again after `close`'''
+        self._closed = False
+
+    def close(self):
+        self._closed = True
+        if self._file is not None:
+            if self._pooled:
+                get_file_pool().release(self._file)
+            else:
+                self._file.close()
+        self._file = None
+        self._dataset = None
+
+    def _acquire_file(self):
+        '''The open file, acquired from the pool on first use'''
+        if self._closed:
+            raise ValueError('{!r} is closed'.format(self))
+        if self._file is None:
+            self._file = get_file_pool().acquire(self._filename)
+        return self._file
+
+    @property
+    def _stats_filename(self):
+        return os.path.abspath(self._filename)
+
+    def get_read_stats(self):
+        '''Read counters (bytes, chunks, cache hits, time per phase) for
+        this handler's file; see `hxntools.handlers.stats.ReadStats`'''
+        return read_stats.snapshot(self._stats_filename)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception as ex:
+            logger.warning('Failed to close file', exc_info=ex)
+
+
+def normalize_selection(key, shape):
+    '''Convert an index expression into per-axis [start, stop) bounds
+
+    Only integers, unit-stride slices and None (meaning the full axis) are
+    supported, which covers the hyperslabs requested by the handlers.
+
+    Parameters
+    ----------
+    key : int, slice, None or tuple of those
+        The index expression
+    shape : tuple
+        Shape of the indexed dataset
+
+    Returns
+    -------
+    bounds : list of (start, stop)
+    int_axes : list of int
+        Axes indexed by an integer, to be dropped from the result
+    '''
+    if not isinstance(key, tuple):
+        key = (key, )
+
+    if len(key) > len(shape):
+        raise IndexError('Too many indices for dataset of shape {}'
+                         ''.format(shape))
+
+    key = key + (slice(None), ) * (len(shape) - len(key))
+    bounds = []
+    int_axes = []
+    for axis, (idx, size) in enumerate(zip(key, shape)):
+        if idx is None:
+            idx = slice(None)
+
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(size)
+            if step != 1:
+                raise IndexError('Only unit-stride slices are supported')
+            bounds.append((start, max(start, stop)))
+        elif isinstance(idx, (int, np.integer)):
+            idx = int(idx)
+            if idx < 0:
+                idx += size
+            if not 0 <= idx < size:
+                raise IndexError('Index {} out of range for axis {} with '
+                                 'size {}'.format(idx, axis, size))
+            bounds.append((idx, idx + 1))
+            int_axes.append(axis)
+        else:
+            raise TypeError('Unsupported index type: {!r}'.format(idx))
+
+    return bounds, int_axes
+
+
+def contiguous_runs(indices):
+    '''Split sorted, unique indices into runs of consecutive values
+
+    Returns
+    -------
+    runs : list of (start, stop)
+        Half-open ranges, one per run
+    '''
+    indices = np.asarray(indices)
+    if not len(indices):
+        return []
+
+    breaks = np.nonzero(np.diff(indices) != 1)[0] + 1
+    starts = np.concatenate(([0], breaks))
+    stops = np.concatenate((breaks, [len(indices)]))
+    return [(int(indices[i]), int(indices[j - 1]) + 1)
+            for i, j in zip(starts, stops)]
+
+
+def accumulator_dtype(data):
+    '''dtype used to sum integer or float data without overflowing'''
+    return np.float64 if data.dtype.kind == 'f' else np.int64
+
+
+def frames_per_block(dataset, frame_nbytes, block_size=DEFAULT_BLOCK_SIZE):
+    '''Number of frames to read at once for block-wise passes over a dataset
+
+    The block is sized to roughly `block_size` bytes and, for chunked
+    datasets, rounded to whole chunks along the frame axis.
+    '''
+    frames = max(1, int(block_size // max(frame_nbytes, 1)))
+    chunks = getattr(dataset, 'chunks', None)
+    if chunks:
+        rows = chunks[0]
+        frames = max(rows, (frames // rows) * rows)
+    return frames
+
+
+def memmap_dataset(dataset):
+    '''Memory-map a contiguous, uncompressed HDF5 dataset
+
+    Parameters
+    ----------
+    dataset : h5py.Dataset
+
+    Returns
+    -------
+    mapped : np.memmap or None
+        A read-only view of the dataset's bytes in the file, or None if the
+        dataset is chunked, filtered, not yet allocated or otherwise not
+        stored as one plain block in the file
+    '''
+    if dataset.chunks is not None or dataset.size == 0:
+        return None
+
+    if dataset.dtype.hasobject or getattr(dataset, 'external', None):
+        return None
+
+    h5file = dataset.file
+    if h5file.driver not in ('sec2', 'stdio'):
+        return None
+
+    offset = dataset.id.get_offset()
+    if offset is None:
+        return None
+
+    return np.memmap(h5file.filename, mode='r', dtype=dataset.dtype,
+                     offset=offset, shape=dataset.shape, order='C')
+
+
+def can_decompress_chunks(dataset):
+    '''Whether the raw chunks of a dataset can be decoded with plain zlib
+
+    This requires gzip to be the only filter in the pipeline, and an h5py
+    able to tell unallocated chunks apart (get_chunk_info_by_coord).
+    '''
+    if getattr(dataset, 'chunks', None) is None:
+        return False
+    dsid = getattr(dataset, 'id', None)
+    if not (hasattr(dsid, 'read_direct_chunk') and
+            hasattr(dsid, 'get_chunk_info_by_coord')):
+        return False
+    if dataset.compression != 'gzip' or dataset.dtype.hasobject:
+        return False
+    return dsid.get_create_plist().get_nfilters() == 1
+
+
+_decompress_executor = None
+_decompress_executor_lock = threading.Lock()
+
+
+def get_decompress_executor():
+    '''Thread pool shared by all parallel chunk decompression'''
+    global _decompress_executor
+    with _decompress_executor_lock:
+        if _decompress_executor is None:
+            _decompress_executor = ThreadPoolExecutor(
+                max_workers=os.cpu_count() or 1)
+        return _decompress_executor
+
+
+def read_chunks_parallel(dataset, key=None, *, executor=None):
+    '''Read a zlib-compressed dataset, inflating chunks on a thread pool
+
+    The raw chunks are fetched one by one from HDF5 and zlib (which releases
+    the GIL) decompresses them concurrently, each worker copying its chunk
+    straight into the preallocated output array.
+
+    Parameters
+    ----------
+    dataset : h5py.Dataset
+        A dataset for which `can_decompress_chunks` is True
+    key : index expression, optional
+        Integers and unit-stride slices, defaults to the full dataset
+    executor : concurrent.futures.Executor, optional
+        Defaults to the shared decompression pool
+    '''
+    if executor is None:
+        executor = get_decompress_executor()
+
+    shape = tuple(dataset.shape)
+    chunks = tuple(dataset.chunks)
+    dtype = dataset.dtype
+    bounds, int_axes = normalize_selection(key, shape)
+    out = np.empty([stop - start for start, stop in bounds], dtype=dtype)
+
+    filename = dataset_filename(dataset)
+
+    def decode(chunk_idx, filter_mask, raw):
+        chunk_slices, src, dest = chunk_overlap(chunk_idx, chunks, shape,
+                                                bounds)
+        if raw is None:
+            # chunk never written
+            out[dest] = dataset.fillvalue
+            return
+
+        with read_stats.timed(filename, 'decompress'):
+            if not filter_mask & 1:
+                raw = zlib.decompress(raw)
+            chunk = np.frombuffer(raw, dtype=dtype).reshape(chunks)
+            out[dest] = chunk[src]
+
+    # bound the amount of raw data waiting to be decompressed
+    max_pending = 4 * (os.cpu_count() or 1)
+    pending = deque()
+    num_chunks = raw_bytes = 0
+    read_time = 0.0
+    for chunk_idx in iter_chunk_indices(chunks, bounds):
+        offset = tuple(idx * chunk for idx, chunk in zip(chunk_idx, chunks))
+        t0 = time.perf_counter()
+        info = dataset.id.get_chunk_info_by_coord(offset)
+        if info.byte_offset is None or not info.size:
+            # unallocated: reads as the fill value; any other failure of
+            # read_direct_chunk is a real I/O error and propagates
+            filter_mask, raw = 0, None
+        else:
+            filter_mask, raw = dataset.id.read_direct_chunk(offset)
+            raw_bytes += len(raw)
+        read_time += time.perf_counter() - t0
+        num_chunks += 1
+
+        pending.append(executor.submit(decode, chunk_idx, filter_mask, raw))
+        while len(pending) > max_pending:
+            pending.popleft().result()
+
+    while pending:
+        pending.popleft().result()
+
+    read_stats.add(filename, bytes_read=raw_bytes, chunks=num_chunks)
+    read_stats.add_time(filename, 'read', read_time)
+
+    if int_axes:
+        out = out[tuple(0 if axis in int_axes else slice(None)
+                        for axis in range(out.ndim))]
+    return out
+
+
+def read_dataset(dataset, key=None, *, parallel_decompress=True):
+    '''Read a selection of a dataset, decompressing in parallel if possible
+
+    Datasets other than zlib-compressed HDF5 datasets (e.g., numpy arrays or
+    memory-mapped datasets) are simply indexed.
+    '''
+    if parallel_decompress and can_decompress_chunks(dataset):
+        return read_chunks_parallel(dataset, key)
+
+    if key is None:
+        key = slice(None)
+
+    filename = dataset_filename(dataset)
+    with read_stats.timed(filename, 'read'):
+        data = dataset[key]
+
+    if read_stats.enabled:
+        counts = dict(bytes_read=getattr(data, 'nbytes', 0))
+        chunks = getattr(dataset, 'chunks', None)
+        if chunks is not None:
+            bounds, _ = normalize_selection(key, tuple(dataset.shape))
+            counts['chunks'] = count_chunks(chunks, bounds)
+        read_stats.add(filename, **counts)
+    return data
+
+
+def follow_dataset(filename, key, *, start=0, stop=None, min_frames=1,
+                   poll_interval=0.5, timeout=None, stop_event=None):
+    '''Follow a dataset while it is being written in SWMR mode
+
+    The file is opened for single-writer/multiple-reader access and the
+    dataset extent is refreshed every `poll_interval` seconds.  Waits for the
+    file and dataset to be created if they do not exist yet.
+
+    Parameters
+    ----------
+    filename : str
+        HDF5 filename
+    key : str
+        Dataset path
+    start : int, optional
+        First frame to report
+    stop : int, optional
+        Stop following once this many frames are available
+    min_frames : int, optional
+        Report new frames in batches of at least this many (except for the
+        final batch)
+    poll_interval : float, optional
+        Seconds between checks for new frames
+    timeout : float, optional
+        Give up after this many seconds without new frames.  By default,
+        follow until `stop` is reached.
+    stop_event : threading.Event, optional
+        Stop following once set
+
+    Yields
+    ------
+    dataset : h5py.Dataset
+        The refreshed dataset
+    first, last : int
+        Half-open range of newly available frames
+    '''
+    pool = get_file_pool()
+    h5file = None
+    dataset = None
+    last_progress = time.monotonic()
+    try:
+        while True:
+            available = start
+            if dataset is None:
+                try:
+                    if h5file is None:
+                        h5file = pool.acquire(filename, swmr=True)
+                    dataset = h5file[key]
+                except (OSError, KeyError):
+                    # not created yet
+                    pass
+
+            if dataset is not None:
+                dataset.refresh()
+                available = dataset.shape[0]
+                if stop is not None:
+                    available = min(available, stop)
+
+                done = stop is not None and available >= stop
+                if available - start >= min_frames or (done and
+                                                       available > start):
+                    yield dataset, start, available
+                    start = available
+                    last_progress = time.monotonic()
+
+                if done:
+                    return
+
+            if (timeout is not None and
+                    time.monotonic() - last_progress > timeout):
+                if dataset is not None and available > start:
+                    yield dataset, start, available
+                return
+
+            if stop_event is None:
+                time.sleep(poll_interval)
+            elif stop_event.wait(poll_interval):
+                return
+    finally:
+        if h5file is not None:
+            pool.release(h5file)
+
+
+def iter_block_ranges(start, stop, block_frames):
+    '''Half-open (start, stop) ranges of at most block_frames frames'''
+    for block_start in range(start, stop, block_frames):
+        yield block_start, min(block_start + block_frames, stop)
+
+
+def prefetch_blocks(read_block, ranges, *, depth=2):
+    '''Read blocks on a background thread, ahead of the consumer
+
+    Parameters
+    ----------
+    read_block : callable
+        read_block(start, stop) returns the data for one block
+    ranges : iterable of (start, stop)
+        The blocks to read, in order
+    depth : int, optional
+        Maximum number of blocks queued ahead of the consumer; counting the
+        block being read and the one the consumer holds, up to `depth + 2`
+        blocks are in memory at once
+
+    Yields
+    ------
+    start : int
+        Start of the block
+    data
+        The return value of read_block
+    '''
+    queue = Queue(maxsize=max(depth, 1))
+    stop_event = threading.Event()
+
+    def put(item):
+        while not stop_event.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+            except Full:
+                continue
+            return True
+        return False
+
+    def worker():
+        try:
+            for start, stop in ranges:
+                if stop_event.is_set():
+                    return
+                if not put(('block', start, read_block(start, stop))):
+                    return
+        except Exception as ex:
+            put(('error', None, ex))
+        else:
+            put(('done', None, None))
+
+    thread = threading.Thread(target=worker, daemon=True,
+                              name='prefetch_blocks')
+    thread.start()
+    try:
+        while True:
+            try:
+                kind, start, data = queue.get(timeout=0.1)
+            except Empty:
+                if not thread.is_alive() and queue.empty():
+                    return
+                continue
+
+            if kind == 'done':
+                return
+            elif kind == 'error':
+                raise data
+            yield start, data
+    finally:
+        # consumer finished or gave up early: let the reader thread exit
+        stop_event.set()
+
+
+def iter_chunk_indices(chunks, bounds):
+    '''Iterate over the grid indices of all chunks intersecting bounds'''
+    ranges = []
+    for chunk, (start, stop) in zip(chunks, bounds):
+        if stop <= start:
+            return
+        ranges.append(range(start // chunk, (stop - 1) // chunk + 1))
+
+    for chunk_idx in itertools.product(*ranges):
+        yield chunk_idx
+
+
+def count_chunks(chunks, bounds):
+    '''Number of chunks intersecting bounds'''
+    count = 1
+    for chunk, (start, stop) in zip(chunks, bounds):
+        if stop <= start:
+            return 0
+        count *= (stop - 1) // chunk - start // chunk + 1
+    return count
+
+
+def chunk_overlap(chunk_idx, chunks, shape, bounds):
+    '''Source/destination slices of the overlap between a chunk and bounds
+
+    Returns
+    -------
+    chunk_slices : tuple of slice
+        Region of the chunk covering the dataset extent
+    src : tuple of slice
+        Overlapping region, relative to the chunk origin
+    dest : tuple of slice
+        Overlapping region, relative to the selection origin
+    '''
+    chunk_slices, src, dest = [], [], []
+    for idx, chunk, size, (start, stop) in zip(chunk_idx, chunks, shape,
+                                               bounds):
+        origin = idx * chunk
+        end = min(origin + chunk, size)
+        low, high = max(start, origin), min(stop, end)
+        chunk_slices.append(slice(origin, end))
+        src.append(slice(low - origin, high - origin))
+        dest.append(slice(low - start, high - start))
+
+    return tuple(chunk_slices), tuple(src), tuple(dest)
+
+
+class ChunkCachedDataset(object):
+    '''Read-only view of an h5py dataset with an LRU cache of decoded chunks
+
+    Indexing reads only the chunks which intersect the selection, one
+    chunk-aligned hyperslab at a time, so HDF5 never decodes data that is not
+    needed.  Recently used chunks are kept up to `cache_size` bytes.
+
+    Parameters
+    ----------
+    dataset : h5py.Dataset
+        The dataset to wrap
+    cache_size : int, optional
+        Maximum number of bytes of decoded chunks to keep around
+    '''
+    def __init__(self, dataset, *, cache_size=DEFAULT_CHUNK_CACHE_SIZE):
+        self.dataset = dataset
+        self.shape = tuple(dataset.shape)
+        self.dtype = dataset.dtype
+
+        chunks = dataset.chunks
+        if chunks is None:
+            # contiguous storage: treat every frame as a single chunk
+            chunks = (1, ) + self.shape[1:]
+
+        self.chunks = tuple(chunks)
+        self.filename = dataset_filename(dataset)
+        self.cache_size = int(cache_size)
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self._cache_lock = threading.Lock()
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def clear_cache(self):
+        with self._cache_lock:
+            self._cache.clear()
+            self._cache_bytes = 0
+
+    def _get_chunk(self, chunk_idx, chunk_slices):
+        with self._cache_lock:
+            chunk = self._cache.get(chunk_idx)
+            if chunk is not None:
+                self._cache.move_to_end(chunk_idx)
+
+        if chunk is not None:
+            read_stats.add(self.filename, cache_hits=1)
+            return chunk
+
+        # concurrent readers missing on the same chunk may both read it;
+        # the cache stays consistent either way
+        with read_stats.timed(self.filename, 'read'):
+            chunk = self.dataset[chunk_slices]
+        read_stats.add(self.filename, cache_misses=1, chunks=1,
+                       bytes_read=chunk.nbytes)
+        if chunk.nbytes > self.cache_size:
+            return chunk
+
+        with self._cache_lock:
+            if chunk_idx not in self._cache:
+                self._cache[chunk_idx] = chunk
+                self._cache_bytes += chunk.nbytes
+                while len(self._cache) > 1 and (self._cache_bytes >
+                                                self.cache_size):
+                    _, evicted = self._cache.popitem(last=False)
+                    self._cache_bytes -= evicted.nbytes
+        return chunk
+
+    def __getitem__(self, key):
+        bounds, int_axes = normalize_selection(key, self.shape)
+        out = np.empty([stop - start for start, stop in bounds],
+                       dtype=self.dtype)
+
+        for chunk_idx in iter_chunk_indices(self.chunks, bounds):
+            chunk_slices, src, dest = chunk_overlap(chunk_idx, self.chunks,
+                                                    self.shape, bounds)
+            out[dest] = self._get_chunk(chunk_idx, chunk_slices)[src]
+
+        if int_axes:
+            out = out[tuple(0 if axis in int_axes else slice(None)
+                            for axis in range(out.ndim))]
+        return out
+
+    def __repr__(self):
+        return ('{0.__class__.__name__}(dataset={0.dataset!r}, '
+                'cache_size={0.cache_size})'.format(self))
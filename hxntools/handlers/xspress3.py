@@ -3,89 +3,524 @@ from __future__ import print_function
 import h5py
 import numpy as np
 import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from filestore.handlers import HandlerBase
+from .roi_cache import get_default_roi_cache
+from .stats import (read_stats, dataset_filename)
+from .utils import (ChunkCachedDataset, PooledFileMixin, ReadWriteLock,
+                    DEFAULT_BLOCK_SIZE, DEFAULT_CHUNK_CACHE_SIZE,
+                    accumulator_dtype, contiguous_runs, follow_dataset,
+                    frames_per_block, iter_block_ranges, memmap_dataset,
+                    read_dataset)
 
 
 logger = logging.getLogger(__name__)
 
 FMT_ROI_KEY = 'entry/instrument/detector/NDAttributes/CHAN{}ROI{}'
 XRF_DATA_KEY = 'entry/instrument/detector/data'
+# passed instead of a 1-based channel number to select the sum over all
+# channels
+SUM_CHANNEL = 'sum'
 
 
-class Xspress3HDF5Handler(HandlerBase):
+class Xspress3HDF5Handler(PooledFileMixin, HandlerBase):
+    '''Handler for Xspress3 HDF5 files
+
+    A single handler may be shared between threads: any number of reads run
+    concurrently, the dataset is loaded exactly once, and `close` waits for
+    in-flight reads to finish.
+    '''
     specs = {'XSP3'} | HandlerBase.specs
     HANDLER_NAME = 'XSP3'
 
-    def __init__(self, filename, key=XRF_DATA_KEY):
+    def __init__(self, filename, key=XRF_DATA_KEY, *, lazy=True,
+                 chunk_cache_size=DEFAULT_CHUNK_CACHE_SIZE, mmap=True,
+                 parallel_decompress=True, roi_cache=None):
         if isinstance(filename, h5py.File):
             self._file = filename
             self._filename = self._file.filename
+            self._pooled = False
         else:
             self._filename = filename
             self._file = None
+            # share open files with other handlers through the file pool
+            self._pooled = True
         self._key = key
         self._dataset = None
+        # lazy: read only the chunks holding the requested frames/channels
+        # instead of loading the whole dataset on the first call
+        self._lazy = lazy
+        self._chunk_cache_size = chunk_cache_size
+        # mmap: map contiguous, uncompressed datasets straight from the file
+        self._mmap = mmap
+        # parallel_decompress: inflate zlib chunks of block reads on a pool
+        self._parallel_decompress = parallel_decompress
+        # roi_cache: opt-in; True for the default on-disk ROI cache, a
+        # RoiCache instance, or None/False (default) to always recompute
+        self._roi_cache = roi_cache
 
-        self.open()
+        # reads hold the lock shared; open/close hold it exclusively
+        self._lock = ReadWriteLock()
+        self._load_lock = threading.Lock()
+        self._closed = False
 
     def open(self):
-        if self._file:
-            return
-
-        self._file = h5py.File(self._filename, 'r')
+        with self._lock.writing():
+            super(Xspress3HDF5Handler, self).open()
 
     def close(self):
-        super(Xspress3HDF5Handler, self).close()
-        self._file.close()
-        self._file = None
-        self._dataset = None
+        with self._lock.writing():
+            super(Xspress3HDF5Handler, self).close()
 
     @property
     def dataset(self):
         return self._dataset
 
     def _get_dataset(self):
-        if self._dataset is not None:
-            return
+        '''Load the dataset once, returning it (call with the read lock)'''
+        dataset = self._dataset
+        if dataset is not None:
+            return dataset
+
+        with self._load_lock:
+            if self._dataset is None:
+                h5file = self._acquire_file()
+                self._dataset = self._load_dataset(h5file[self._key])
+            return self._dataset
+
+    def _load_dataset(self, hdf_dataset):
+        if self._mmap:
+            mapped = memmap_dataset(hdf_dataset)
+            if mapped is not None:
+                return mapped
+
+        if self._lazy:
+            return ChunkCachedDataset(hdf_dataset,
+                                      cache_size=self._chunk_cache_size)
 
-        hdf_dataset = self._file[self._key]
         try:
-            self._dataset = np.asarray(hdf_dataset)
+            return np.asarray(hdf_dataset)
         except MemoryError as ex:
             logger.warning('Unable to load the full dataset into memory',
                            exc_info=ex)
-            self._dataset = hdf_dataset
+            return hdf_dataset
 
-    def __del__(self):
-        try:
-            self.close()
-        except Exception as ex:
-            logger.warning('Failed to close file',
-                           exc_info=ex)
+    def __call__(self, frame=None, channel=None, *, bin_low=None,
+                 bin_high=None, rebin=1):
+        '''Read one spectrum
 
-    def __call__(self, frame=None, channel=None):
-        # Don't read out the dataset until it is requested for the first time.
-        self._get_dataset()
-        return self._dataset[frame, channel - 1, :].squeeze()
+        Parameters
+        ----------
+        frame : int
+            Frame index
+        channel : int or SUM_CHANNEL
+            1-based channel number, or SUM_CHANNEL for the sum over all
+            channels
+        bin_low, bin_high : int, optional
+            Only return bins [bin_low, bin_high)
+        rebin : int, optional
+            Sum groups of this many adjacent bins
+        '''
+        bins = slice(bin_low, bin_high)
+        with self._lock.reading():
+            # Don't read out the dataset until it is requested for the first
+            # time.
+            dataset = self._get_dataset()
+            if isinstance(channel, str) and channel == SUM_CHANNEL:
+                spectrum = dataset[frame, :, bins]
+                spectrum = spectrum.sum(axis=-2,
+                                        dtype=accumulator_dtype(spectrum))
+            else:
+                spectrum = dataset[frame, channel - 1, bins]
 
-    def get_roi(self, chan, bin_low, bin_high, *, frame=None, max_points=None):
-        self._get_dataset()
+        return rebin_spectra(spectrum, rebin).squeeze()
 
-        roi = np.sum(self._dataset[:, chan - 1, bin_low:bin_high], axis=1)
-        if max_points is not None:
-            roi = roi[:max_points]
+    def _full_dataset(self):
+        '''The dataset to use for reads spanning all frames'''
+        dataset = self._get_dataset()
+        if isinstance(dataset, ChunkCachedDataset):
+            # bypass the chunk cache, which would only be thrashed
+            return dataset.dataset
+        return dataset
+
+    def _read(self, dataset, key):
+        return read_dataset(dataset, key,
+                            parallel_decompress=self._parallel_decompress)
+
+    def get_frames(self, frames, channels=None, *, sum_channels=False,
+                   bin_low=None, bin_high=None, rebin=1,
+                   block_size=DEFAULT_BLOCK_SIZE):
+        '''Read the spectra of many frames and channels at once
+
+        Consecutive frames are merged into slice reads of about `block_size`
+        bytes, so a full fly scan costs one pass over the file.  Reductions
+        are applied block by block as the data is read, so memory use scales
+        with the reduced output.
+
+        Parameters
+        ----------
+        frames : sequence of int
+            Frame indices, in any order (duplicates allowed)
+        channels : sequence of int, optional
+            1-based channel numbers, defaults to all channels
+        sum_channels : bool, optional
+            Return the sum over the requested channels as a single channel
+        bin_low, bin_high : int, optional
+            Only read bins [bin_low, bin_high)
+        rebin : int, optional
+            Sum groups of this many adjacent bins (trailing bins which do not
+            fill a whole group are dropped)
+        block_size : int, optional
+            Approximate number of bytes to read at once
+
+        Returns
+        -------
+        spectra : np.ndarray
+            Shape (len(frames), len(channels), num_bins) ordered as requested,
+            where len(channels) is 1 with sum_channels and num_bins reflects
+            the bin range and rebinning
+        '''
+        with self._lock.reading():
+            return self._get_frames(frames, channels,
+                                    sum_channels=sum_channels,
+                                    bins=slice(bin_low, bin_high),
+                                    rebin=rebin, block_size=block_size)
+
+    def _get_frames(self, frames, channels, *, sum_channels=False,
+                    bins=slice(None), rebin=1, block_size=DEFAULT_BLOCK_SIZE):
+        dataset = self._full_dataset()
+
+        frames = np.asarray(frames, dtype=int).ravel()
+        if channels is None:
+            channels = range(1, dataset.shape[1] + 1)
+        ch_idx = np.asarray(channels, dtype=int).ravel() - 1
+
+        bin_low, bin_high, _ = bins.indices(dataset.shape[2])
+        bin_high = max(bin_low, bin_high)
+        num_bins = bin_high - bin_low
+        reduced = sum_channels or rebin != 1
+        if rebin != 1:
+            num_bins //= rebin
+        out_channels = 1 if sum_channels else len(ch_idx)
+        dtype = accumulator_dtype(dataset) if reduced else dataset.dtype
 
-            if len(roi) < max_points:
-                roi = np.pad(roi, ((0, max_points - len(roi)), ), 'constant')
+        if not len(frames) or not len(ch_idx):
+            return np.empty((len(frames), out_channels, num_bins),
+                            dtype=dtype)
 
+        unique_frames, inverse = np.unique(frames, return_inverse=True)
+
+        # one hyperslab along the channel axis covers every channel requested
+        ch_low, ch_high = int(ch_idx.min()), int(ch_idx.max()) + 1
+        ch_sel = ch_idx - ch_low
+        all_channels = np.array_equal(ch_sel, np.arange(ch_high - ch_low))
+
+        frame_nbytes = ((ch_high - ch_low) * (bin_high - bin_low) *
+                        dataset.dtype.itemsize)
+        block_frames = frames_per_block(dataset, frame_nbytes, block_size)
+
+        spectra = np.empty((len(unique_frames), out_channels, num_bins),
+                           dtype=dtype)
+        filename = dataset_filename(dataset)
+        row = 0
+        for run_start, run_stop in contiguous_runs(unique_frames):
+            for start, stop in iter_block_ranges(run_start, run_stop,
+                                                 block_frames):
+                block = self._read(dataset, (slice(start, stop),
+                                             slice(ch_low, ch_high),
+                                             slice(bin_low, bin_high)))
+                with read_stats.timed(filename, 'index'):
+                    if not all_channels:
+                        block = block[:, ch_sel, :]
+                    if sum_channels:
+                        block = block.sum(axis=1, keepdims=True, dtype=dtype)
+                    spectra[row:row + stop - start] = rebin_spectra(block,
+                                                                    rebin)
+                row += stop - start
+
+        if np.array_equal(unique_frames, frames):
+            return spectra
+
+        with read_stats.timed(filename, 'index'):
+            return spectra[inverse]
+
+    def get_datums(self, datum_kwargs):
+        '''Read the spectra for a list of datum keyword arguments
+
+        Parameters
+        ----------
+        datum_kwargs : iterable of dict
+            Datum kwargs of the form {'frame': ..., 'channel': ...}
+
+        Returns
+        -------
+        frames : list of int
+            Sorted unique frame indices
+        channels : list of int
+            Sorted unique channel numbers
+        spectra : np.ndarray
+            Shape (len(frames), len(channels), num_bins)
+        '''
+        datum_kwargs = list(datum_kwargs)
+        frames = sorted(set(kw['frame'] for kw in datum_kwargs))
+        channels = sorted(set(kw['channel'] for kw in datum_kwargs))
+        return frames, channels, self.get_frames(frames, channels)
+
+    def get_roi(self, chan, bin_low, bin_high, *, frame=None, max_points=None):
+        roi, = self.get_rois([(chan, bin_low, bin_high)],
+                             max_points=max_points)
         if frame is not None:
             roi = roi[frame, :]
 
         return roi
 
+    def get_rois(self, rois, *, start=0, stop=None, max_points=None,
+                 block_size=DEFAULT_BLOCK_SIZE, max_workers=None):
+        '''Compute many ROI sums in a single pass over the frames
+
+        Frames are streamed in blocks spanning every channel and bin window
+        requested.  Each block is summed per channel on a thread pool while
+        the next block is read; channels with several ROIs use one
+        cumulative sum along the bin axis instead of one sum per ROI.
+
+        Parameters
+        ----------
+        rois : sequence of (chan, bin_low, bin_high)
+            1-based channel number and [bin_low, bin_high) window
+        start : int, optional
+            First frame to include
+        stop : int, optional
+            Frame after the last to include, defaults to all frames
+        max_points : int, optional
+            Truncate or zero-pad the results to this length
+        block_size : int, optional
+            Approximate number of bytes to read per block
+        max_workers : int, optional
+            Worker threads, defaults to the number of channels involved
+
+        Returns
+        -------
+        roi_data : list of np.ndarray
+            One array per ROI, in the order given
+
+        Notes
+        -----
+        By default every ROI is computed from the file.  If the handler was
+        created with a `roi_cache`, full-length ROIs (start=0, stop=None)
+        are looked up in and added to that on-disk cache, so only ROIs not
+        computed before are read from the file.
+        '''
+        with self._lock.reading():
+            return self._get_rois(rois, start=start, stop=stop,
+                                  max_points=max_points,
+                                  block_size=block_size,
+                                  max_workers=max_workers)
+
+    def _get_rois(self, rois, *, start, stop, max_points, block_size,
+                  max_workers):
+        dataset = self._full_dataset()
+        rois = list(rois)
+        cache = self.roi_cache
+        keys = None
+        if cache is not None and start == 0 and stop is None:
+            try:
+                keys = [cache.make_key(self._filename, self._key, *roi)
+                        for roi in rois]
+            except OSError:
+                keys = None
+
+        if keys is None:
+            return self._rois_from_dataset(
+                dataset, rois, start=start, stop=stop,
+                max_points=max_points, block_size=block_size,
+                max_workers=max_workers)
+
+        results = [cache.get(key) for key in keys]
+        missing = [idx for idx, roi in enumerate(results) if roi is None]
+        read_stats.add(self._stats_filename,
+                       roi_cache_hits=len(results) - len(missing),
+                       roi_cache_misses=len(missing))
+        if missing:
+            computed = self._rois_from_dataset(
+                dataset, [rois[idx] for idx in missing],
+                start=start, stop=stop, max_points=None,
+                block_size=block_size, max_workers=max_workers)
+
+            for idx, roi in zip(missing, computed):
+                results[idx] = roi
+                try:
+                    cache.put(keys[idx], roi)
+                except OSError as ex:
+                    logger.warning('Failed to store ROI in the cache',
+                                   exc_info=ex)
+
+        if max_points is not None:
+            results = [_pad_roi(roi, max_points) for roi in results]
+        return results
+
+    @property
+    def roi_cache(self):
+        '''The RoiCache consulted by get_rois, or None'''
+        if self._roi_cache is True:
+            return get_default_roi_cache()
+        return self._roi_cache or None
+
+    def _rois_from_dataset(self, dataset, rois, *, start, stop, max_points,
+                           block_size, max_workers):
+        num_frames, _, num_bins = dataset.shape
+        stop = num_frames if stop is None else min(stop, num_frames)
+        count = max(stop - start, 0)
+
+        acc_dtype = accumulator_dtype(dataset)
+        results = [np.zeros(count, dtype=acc_dtype) for roi in rois]
+
+        by_channel = OrderedDict()
+        for idx, (chan, bin_low, bin_high) in enumerate(rois):
+            bin_low = min(max(int(bin_low), 0), num_bins)
+            bin_high = min(max(int(bin_high), bin_low), num_bins)
+            by_channel.setdefault(int(chan), []).append(
+                (idx, bin_low, bin_high))
+
+        if by_channel and count:
+            self._sum_rois(dataset, by_channel, results, start, stop,
+                           block_size=block_size, max_workers=max_workers)
+
+        if max_points is not None:
+            results = [_pad_roi(roi, max_points) for roi in results]
+        return results
+
+    def _sum_rois(self, dataset, by_channel, results, start, stop, *,
+                  block_size, max_workers):
+        ch_low = min(by_channel) - 1
+        ch_high = max(by_channel)
+        bin_low = min(low for rois in by_channel.values()
+                      for idx, low, high in rois)
+        bin_high = max(high for rois in by_channel.values()
+                       for idx, low, high in rois)
+
+        frame_nbytes = ((ch_high - ch_low) * max(bin_high - bin_low, 1) *
+                        dataset.dtype.itemsize)
+        block_frames = frames_per_block(dataset, frame_nbytes, block_size)
+        if max_workers is None:
+            max_workers = len(by_channel)
+
+        filename = dataset_filename(dataset)
+
+        def sum_channel(*args):
+            with read_stats.timed(filename, 'roi_sum'):
+                _sum_channel_rois(*args)
+
+        def read_block(block_start):
+            block_stop = min(block_start + block_frames, stop)
+            return self._read(dataset, (slice(block_start, block_stop),
+                                        slice(ch_low, ch_high),
+                                        slice(bin_low, bin_high)))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            block_start = start
+            block = read_block(block_start)
+            while block is not None:
+                row = block_start - start
+                futures = [executor.submit(sum_channel,
+                                           block[:, chan - 1 - ch_low, :],
+                                           chan_rois, bin_low, results, row)
+                           for chan, chan_rois in by_channel.items()]
+
+                # overlap reading the next block with the summation
+                block_start += len(block)
+                block = (read_block(block_start) if block_start < stop
+                         else None)
+
+                for future in futures:
+                    future.result()
+
+    def follow(self, *, start=0, stop=None, min_frames=1, poll_interval=0.5,
+               timeout=None, stop_event=None):
+        '''Yield spectra as they are written, following the file in SWMR mode
+
+        Parameters are as in `hxntools.handlers.utils.follow_dataset`.
+
+        Yields
+        ------
+        first : int
+            Index of the first frame in the batch
+        spectra : np.ndarray
+            Shape (num_new_frames, num_channels, num_bins)
+        '''
+        for dataset, first, last in follow_dataset(
+                self._filename, self._key, start=start, stop=stop,
+                min_frames=min_frames, poll_interval=poll_interval,
+                timeout=timeout, stop_event=stop_event):
+            yield first, self._read(dataset, slice(first, last))
+
+    def follow_rois(self, rois, *, start=0, stop=None, min_frames=1,
+                    poll_interval=0.5, timeout=None, stop_event=None,
+                    block_size=DEFAULT_BLOCK_SIZE, max_workers=None):
+        '''Compute ROI sums incrementally while the file is being written
+
+        Parameters are as in `hxntools.handlers.utils.follow_dataset`, and
+        `rois`, `block_size` and `max_workers` as in `get_rois`.
+
+        Yields
+        ------
+        first : int
+            Index of the first frame in the batch
+        roi_data : list of np.ndarray
+            One array per ROI, covering only the new frames
+        '''
+        for dataset, first, last in follow_dataset(
+                self._filename, self._key, start=start, stop=stop,
+                min_frames=min_frames, poll_interval=poll_interval,
+                timeout=timeout, stop_event=stop_event):
+            yield first, self._rois_from_dataset(
+                dataset, rois, start=first, stop=last, max_points=None,
+                block_size=block_size, max_workers=max_workers)
+
     def __repr__(self):
-        return '{0.__class__.__name__}(filename={0._filename!r})'.format(self)
+        return ('{0.__class__.__name__}(filename={0._filename!r}, '
+                'lazy={0._lazy}, mmap={0._mmap})'.format(self))
+
+
+def rebin_spectra(spectra, rebin):
+    '''Sum groups of `rebin` adjacent bins along the last axis
+
+    Trailing bins which do not fill a whole group are dropped.
+    '''
+    if rebin == 1:
+        return spectra
+
+    num_bins = spectra.shape[-1] // rebin
+    spectra = spectra[..., :num_bins * rebin]
+    grouped = spectra.reshape(spectra.shape[:-1] + (num_bins, rebin))
+    return grouped.sum(axis=-1, dtype=accumulator_dtype(spectra))
+
+
+def _sum_channel_rois(spectra, rois, bin_offset, results, row):
+    '''Sum one channel's ROIs over a block of spectra into results'''
+    acc_dtype = results[rois[0][0]].dtype
+    count = len(spectra)
+    if len(rois) > 2:
+        cumsum = np.zeros((count, spectra.shape[1] + 1), dtype=acc_dtype)
+        np.cumsum(spectra, axis=1, dtype=acc_dtype, out=cumsum[:, 1:])
+        for idx, low, high in rois:
+            results[idx][row:row + count] = (cumsum[:, high - bin_offset] -
+                                             cumsum[:, low - bin_offset])
+    else:
+        for idx, low, high in rois:
+            window = spectra[:, low - bin_offset:high - bin_offset]
+            results[idx][row:row + count] = np.sum(window, axis=1,
+                                                   dtype=acc_dtype)
+
+
+def _pad_roi(roi, max_points):
+    '''Truncate or zero-pad an ROI to max_points'''
+    roi = roi[:max_points]
+    if len(roi) < max_points:
+        roi = np.pad(roi, ((0, max_points - len(roi)), ), 'constant')
+    return roi
 
 
 def register():
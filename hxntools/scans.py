@@ -1,6 +1,9 @@
 import asyncio
 import functools
 import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import (ThreadPoolExecutor, Future)
 
 from boltons.iterutils import chunked
 
@@ -10,6 +13,9 @@ from bluesky import plan_patterns
 
 from ophyd import (Device, Component as Cpt, EpicsSignal)
 from .detectors.trigger_mixins import HxnModalBase
+from .detectors.staging import (ConcurrentStageMixin, stage_devices,
+                                release_prestaged)
+from .timing import (get_tracer, traced_command)
 
 logger = logging.getLogger(__name__)
 
@@ -36,8 +42,110 @@ def get_next_scan_id():
     return dev_scan_id.get_next_scan_id()
 
 
+class DetectorSetupError(RuntimeError):
+    '''Raised when one or more detectors failed to set up
+
+    Attributes
+    ----------
+    errors : list of (detector, exception)
+    '''
+    def __init__(self, phase, errors):
+        self.phase = phase
+        self.errors = list(errors)
+        super().__init__('{} setup failed for: {}'.format(
+            phase, ', '.join('{} ({!r})'.format(det.name, ex)
+                             for det, ex in self.errors)))
+
+
+_setup_executor = None
+_setup_timings = OrderedDict()
+
+
+def _get_setup_executor():
+    global _setup_executor
+    if _setup_executor is None:
+        _setup_executor = ThreadPoolExecutor(max_workers=8)
+    return _setup_executor
+
+
+def get_setup_timings():
+    '''Per-detector times, in seconds, of the last hxn_scan_setup
+
+    Returns
+    -------
+    timings : OrderedDict
+        {phase: {detector name: seconds}}, phases being internal, external
+        and stage
+    '''
+    return OrderedDict((phase, OrderedDict(timings))
+                       for phase, timings in _setup_timings.items())
+
+
+def _timed(func, *args):
+    t0 = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - t0
+
+
 @asyncio.coroutine
-def cmd_scan_setup(msg):
+def _setup_concurrently(phase, func, detectors):
+    '''Run func(det) for all detectors on the setup thread pool
+
+    Waits for all of them, then raises DetectorSetupError if any failed.
+    '''
+    detectors = list(detectors)
+    if not detectors:
+        return OrderedDict()
+
+    loop = asyncio.get_event_loop()
+    executor = _get_setup_executor()
+    futures = [loop.run_in_executor(executor, _timed, func, det)
+               for det in detectors]
+    yield from asyncio.wait(futures)
+
+    timings = OrderedDict()
+    errors = []
+    for det, future in zip(detectors, futures):
+        ex = future.exception()
+        if ex is not None:
+            logger.error('[%s] Failed to set up detector %s', phase,
+                         det.name, exc_info=ex)
+            errors.append((det, ex))
+        else:
+            timings[det.name] = future.result()
+
+    _setup_timings[phase] = timings
+    if errors:
+        raise DetectorSetupError(phase, errors)
+
+    logger.debug('[%s] Detector setup times: %s', phase,
+                 ', '.join('{} ({:.3f} s)'.format(name, elapsed)
+                           for name, elapsed in timings.items()))
+    return timings
+
+
+def _setup_internal(det, *, total_points, count_time):
+    logger.debug('[internal trigger] Setting up detector %s', det.name)
+    settings = det.mode_settings
+
+    # Ensure count time is set prior to mode setup
+    det.count_time.put(count_time)
+
+    # start by using internal triggering
+    settings.mode.put('internal')
+    settings.scan_type.put('step')
+    settings.total_points.put(total_points)
+    det.mode_setup('internal')
+
+
+def _setup_external(det):
+    logger.debug('[external trigger] Setting up detector %s', det)
+    det.mode_settings.mode.put('external')
+    det.mode_setup('external')
+
+
+@asyncio.coroutine
+def cmd_scan_setup(msg, *, prestage=False):
     detectors = msg.kwargs['detectors']
     total_points = msg.kwargs['total_points']
     count_time = msg.kwargs['count_time']
@@ -45,19 +153,13 @@ def cmd_scan_setup(msg):
     modal_dets = [det for det in detectors
                   if isinstance(det, HxnModalBase)]
 
-    mode = 'internal'
-    for det in modal_dets:
-        logger.debug('[internal trigger] Setting up detector %s', det.name)
-        settings = det.mode_settings
-
-        # Ensure count time is set prior to mode setup
-        det.count_time.put(count_time)
-
-        # start by using internal triggering
-        settings.mode.put(mode)
-        settings.scan_type.put('step')
-        settings.total_points.put(total_points)
-        det.mode_setup(mode)
+    _setup_timings.clear()
+    # detectors are set up concurrently, one phase after the other
+    yield from _setup_concurrently(
+        'internal', functools.partial(_setup_internal,
+                                      total_points=total_points,
+                                      count_time=count_time),
+        modal_dets)
 
     # the mode setup above should update to inform us which detectors
     # are externally triggered, in the form of the list in
@@ -72,59 +174,204 @@ def cmd_scan_setup(msg):
     logger.debug('These detectors will be externally triggered: %s',
                  ', '.join(det.name for det in triggered_dets))
 
-    mode = 'external'
-    for det in triggered_dets:
-        logger.debug('[external trigger] Setting up detector %s', det)
-        det.mode_settings.mode.put(mode)
-        det.mode_setup(mode)
+    yield from _setup_concurrently('external', _setup_external,
+                                   triggered_dets)
+
+    if prestage:
+        # stage all detectors at once; the RunEngine's stage reuses this
+        loop = asyncio.get_event_loop()
+        # externally triggered detectors are ready before their triggers;
+        # the prestage is only reused for the scan ID reserved for it
+        timings = yield from loop.run_in_executor(
+            _get_setup_executor(), functools.partial(
+                stage_devices, [det for det in modal_dets
+                                if isinstance(det, ConcurrentStageMixin)],
+                first=triggered_dets, tag=_pending_scan_id))
+        _setup_timings['stage'] = timings
+        logger.info('Staged detectors: %s',
+                    ', '.join('{} ({:.2f} s)'.format(name, elapsed)
+                              for name, elapsed in timings.items()))
+
+
+@asyncio.coroutine
+def cmd_release_prestaged(msg):
+    '''Unstage detectors prestaged by hxn_scan_setup but not used'''
+    loop = asyncio.get_event_loop()
+    released = yield from loop.run_in_executor(_get_setup_executor(),
+                                               release_prestaged)
+    if released:
+        logger.info('Unstaged unused prestaged detectors: %s',
+                    ', '.join(det.name for det in released))
+
+
+_scan_id_executor = None
+_pending_scan_id = None
+
+
+def _get_scan_id_executor():
+    global _scan_id_executor
+    if _scan_id_executor is None:
+        _scan_id_executor = ThreadPoolExecutor(max_workers=1)
+    return _scan_id_executor
+
+
+@asyncio.coroutine
+def _start_scan(msg):
+    '''Common start of hxn_next_scan_id and hxn_reserve_scan_id'''
+    # a new scan starts; detectors prestaged for an earlier one are stale
+    yield from cmd_release_prestaged(msg)
+    get_tracer().start_scan()
+
+
+def _store_scan_id(scan_id):
+    '''Make scan_id the ID of the next run opened by the RunEngine
+
+    The IOC hands out the ID of the scan about to run, while the RunEngine
+    increments RE.md['scan_id'] when the run opens, so the ID before it is
+    stored.  hxn_next_scan_id does this in one step; hxn_reserve_scan_id and
+    hxn_commit_scan_id split it so the IOC round trip runs in the
+    background in between.
+    '''
+    get_gs().RE.md['scan_id'] = scan_id - 1
+    get_tracer().label_scan(scan_id)
 
 
 @asyncio.coroutine
 def cmd_next_scan_id(msg):
-    gs = get_gs()
-    gs.RE.md['scan_id'] = get_next_scan_id() - 1
+    '''Get the next scan ID from the IOC and store it in RE.md'''
+    yield from _start_scan(msg)
+    _store_scan_id(get_next_scan_id())
+
+
+@asyncio.coroutine
+def cmd_reserve_scan_id(msg):
+    '''Start reserving the next scan ID in the background
+
+    The ID is stored in RE.md by hxn_commit_scan_id, so that the IOC round
+    trips overlap with whatever runs in between (e.g., hxn_scan_setup).
+    '''
+    global _pending_scan_id
+    yield from _start_scan(msg)
+    _pending_scan_id = _get_scan_id_executor().submit(get_next_scan_id)
+
+
+@asyncio.coroutine
+def cmd_commit_scan_id(msg):
+    '''Wait for the scan ID reservation and store it in RE.md'''
+    global _pending_scan_id
+    future, _pending_scan_id = _pending_scan_id, None
+    if future is None:
+        raise RuntimeError('hxn_reserve_scan_id must precede '
+                           'hxn_commit_scan_id')
+
+    scan_id = yield from asyncio.wrap_future(future)
+    _store_scan_id(scan_id)
 
 
 @asyncio.coroutine
 def _debug_next_scan_id(cmd):
     print('debug_next_scan_id')
     gs = get_gs()
+    get_tracer().start_scan()
     gs.RE.md['scan_id'] = 0
 
 
-def setup(*, debug_mode=False):
+@asyncio.coroutine
+def _debug_reserve_scan_id(cmd):
+    global _pending_scan_id
+    print('debug_reserve_scan_id')
+    get_tracer().start_scan()
+    _pending_scan_id = Future()
+    _pending_scan_id.set_result(1)
+
+
+def setup(*, debug_mode=False, concurrent_stage=False,
+          cache_stage_values=False, timing=False):
+    '''Register the HXN RunEngine commands
+
+    Parameters
+    ----------
+    debug_mode : bool, optional
+        Do not request scan IDs from the IOC
+    concurrent_stage : bool, optional
+        Stage all HxnModalBase detectors concurrently during scan setup
+    cache_stage_values : bool, optional
+        Skip stage puts of settings already at their value, for all
+        ConcurrentStageMixin devices (see its docstring)
+    timing : bool, optional
+        Enable the timing tracer (see hxntools.timing) and record the
+        commands as spans
+    '''
     gs = get_gs()
-    gs.RE.register_command('hxn_scan_setup', cmd_scan_setup)
-
+    ConcurrentStageMixin.cache_stage_values = cache_stage_values
     if debug_mode:
-        gs.RE.register_command('hxn_next_scan_id', _debug_next_scan_id)
+        next_scan_id = _debug_next_scan_id
+        reserve_scan_id = _debug_reserve_scan_id
     else:
-        gs.RE.register_command('hxn_next_scan_id', cmd_next_scan_id)
+        next_scan_id = cmd_next_scan_id
+        reserve_scan_id = cmd_reserve_scan_id
+
+    commands = {'hxn_scan_setup': functools.partial(
+                    cmd_scan_setup, prestage=concurrent_stage),
+                'hxn_next_scan_id': next_scan_id,
+                'hxn_reserve_scan_id': reserve_scan_id,
+                'hxn_commit_scan_id': cmd_commit_scan_id,
+                'hxn_release_prestaged': cmd_release_prestaged,
+                }
+
+    if timing:
+        get_tracer().enabled = True
+        commands = {name: traced_command(name, command)
+                    for name, command in commands.items()}
+
+    for name, command in commands.items():
+        gs.RE.register_command(name, command)
 
 
 def _pre_scan(total_points, count_time):
     gs = get_gs()
-    yield Msg('hxn_next_scan_id')
+    # the scan ID is reserved while the detectors are set up, and committed
+    # before the plan opens the run
+    yield Msg('hxn_reserve_scan_id')
     yield Msg('hxn_scan_setup', detectors=gs.DETS, total_points=total_points,
               count_time=count_time)
+    yield Msg('hxn_commit_scan_id')
+
+
+def _hxn_scan(plan, *, total_points, count_time):
+    '''Set up the detectors, then run plan
+
+    Detectors prestaged by the setup but not staged by the plan (e.g., the
+    scan failed or was aborted before the plan staged them) are unstaged
+    at the end, however the scan ends.
+    '''
+    def setup_and_run():
+        yield from _pre_scan(total_points=total_points, count_time=count_time)
+        return (yield from plan)
+
+    return (yield from plans.finalize_wrapper(
+        setup_and_run(), [Msg('hxn_release_prestaged')]))
 
 
 @functools.wraps(spec_api.ct)
 def count(num=1, delay=None, time=None, *, md=None):
-    yield from _pre_scan(total_points=num, count_time=time)
-    yield from spec_api.ct(num=num, delay=delay, time=time, md=md)
+    yield from _hxn_scan(
+        spec_api.ct(num=num, delay=delay, time=time, md=md),
+        total_points=num, count_time=time)
 
 
 @functools.wraps(spec_api.ascan)
 def absolute_scan(motor, start, finish, intervals, time=None, *, md=None):
-    yield from _pre_scan(total_points=intervals + 1, count_time=time)
-    yield from spec_api.ascan(motor, start, finish, intervals, time, md=md)
+    yield from _hxn_scan(
+        spec_api.ascan(motor, start, finish, intervals, time, md=md),
+        total_points=intervals + 1, count_time=time)
 
 
 @functools.wraps(spec_api.dscan)
 def relative_scan(motor, start, finish, intervals, time=None, *, md=None):
-    yield from _pre_scan(total_points=intervals + 1, count_time=time)
-    yield from spec_api.dscan(motor, start, finish, intervals, time, md=md)
+    yield from _hxn_scan(
+        spec_api.dscan(motor, start, finish, intervals, time, md=md),
+        total_points=intervals + 1, count_time=time)
 
 
 @functools.wraps(spec_api.afermat)
@@ -135,10 +382,11 @@ def absolute_fermat(x_motor, y_motor, x_start, y_start, x_range, y_range, dr,
                                       factor, tilt=tilt)
     total_points = len(cyc)
 
-    yield from _pre_scan(total_points=total_points, count_time=time)
-    yield from spec_api.afermat(x_motor, y_motor, x_start, y_start, x_range,
-                                y_range, dr, factor, time=time,
-                                per_step=per_step, md=md)
+    yield from _hxn_scan(
+        spec_api.afermat(x_motor, y_motor, x_start, y_start, x_range,
+                         y_range, dr, factor, time=time,
+                         per_step=per_step, md=md),
+        total_points=total_points, count_time=time)
 
 
 @functools.wraps(spec_api.fermat)
@@ -149,9 +397,10 @@ def relative_fermat(x_motor, y_motor, x_range, y_range, dr, factor, time=None,
                                       factor, tilt=tilt)
     total_points = len(cyc)
 
-    yield from _pre_scan(total_points=total_points, count_time=time)
-    yield from spec_api.fermat(x_motor, y_motor, x_range, y_range, dr, factor,
-                               time=time, per_step=per_step, md=md)
+    yield from _hxn_scan(
+        spec_api.fermat(x_motor, y_motor, x_range, y_range, dr, factor,
+                        time=time, per_step=per_step, md=md),
+        total_points=total_points, count_time=time)
 
 
 @functools.wraps(spec_api.aspiral)
@@ -162,10 +411,11 @@ def absolute_spiral(x_motor, y_motor, x_start, y_start, x_range, y_range, dr,
                                       nth, tilt=tilt)
     total_points = len(cyc)
 
-    yield from _pre_scan(total_points=total_points, count_time=time)
-    yield from spec_api.aspiral(x_motor, y_motor, x_start, y_start, x_range,
-                                y_range, dr, nth, time=time,
-                                per_step=per_step, md=md)
+    yield from _hxn_scan(
+        spec_api.aspiral(x_motor, y_motor, x_start, y_start, x_range,
+                         y_range, dr, nth, time=time,
+                         per_step=per_step, md=md),
+        total_points=total_points, count_time=time)
 
 
 @functools.wraps(spec_api.spiral)
@@ -176,9 +426,10 @@ def relative_spiral(x_motor, y_motor, x_range, y_range, dr, nth, time=None,
                                       nth, tilt=tilt)
     total_points = len(cyc)
 
-    yield from _pre_scan(total_points=total_points, count_time=time)
-    yield from spec_api.spiral(x_motor, y_motor, x_range, y_range, dr, nth,
-                               time=time, per_step=per_step, md=md)
+    yield from _hxn_scan(
+        spec_api.spiral(x_motor, y_motor, x_range, y_range, dr, nth,
+                        time=time, per_step=per_step, md=md),
+        total_points=total_points, count_time=time)
 
 
 @functools.wraps(spec_api.mesh)
@@ -192,8 +443,9 @@ def absolute_mesh(*args, time=None, md=None):
     for motor, start, stop, num in chunked(args, 4):
         total_points *= num
 
-    yield from _pre_scan(total_points=total_points, count_time=time)
-    yield from spec_api.mesh(*args, time=time, md=md)
+    yield from _hxn_scan(
+        spec_api.mesh(*args, time=time, md=md),
+        total_points=total_points, count_time=time)
 
 
 @functools.wraps(absolute_mesh)
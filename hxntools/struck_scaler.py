@@ -5,7 +5,9 @@ from ophyd import (EpicsScaler, Device,
 from ophyd.mca import EpicsMCARecord
 from ophyd.status import DeviceStatus
 from ophyd.device import Staged
+from .detectors.staging import ConcurrentStageMixin
 from .detectors.trigger_mixins import HxnModalBase
+from .timing import traced_method
 
 
 class MinimalCalcRecord(Device):
@@ -103,7 +105,7 @@ class StruckScaler(EpicsScalerWithCalc):
                              for attr in mca_attrs}
 
 
-class HxnTriggeringScaler(HxnModalBase, StruckScaler):
+class HxnTriggeringScaler(HxnModalBase, StruckScaler, ConcurrentStageMixin):
     def __init__(self, prefix, *, scan_type_triggers=None, **kwargs):
         super().__init__(prefix, **kwargs)
 
@@ -154,6 +156,7 @@ class HxnTriggeringScaler(HxnModalBase, StruckScaler):
         self.stage_sigs[self.erase_start] = 1
         self.stage_sigs.move_to_end(self.erase_start)
 
+    @traced_method('trigger')
     def trigger(self):
         if self._staged != Staged.yes:
             raise RuntimeError("This detector is not ready to trigger."
@@ -0,0 +1,214 @@
+'''Opt-in timing of the scan hot path
+
+Spans (a name, a category, a start time and a duration) are recorded by the
+HXN RunEngine commands and detector mixins while the tracer is enabled, and
+can be exported as a Chrome trace (chrome://tracing or Perfetto) or
+summarised per scan.  When disabled, recording costs one attribute lookup.
+
+Usage::
+
+    from hxntools.timing import get_tracer
+    tracer = get_tracer()
+    tracer.enabled = True
+    # ... run scans ...
+    tracer.print_summary()
+    tracer.dump('trace.json')
+'''
+from __future__ import print_function
+import asyncio
+import functools
+import json
+import os
+import threading
+import time
+from collections import (OrderedDict, deque)
+from contextlib import contextmanager
+
+
+class Tracer(object):
+    '''Records timing spans for a Chrome-trace timeline and summaries
+
+    Parameters
+    ----------
+    enabled : bool, optional
+        Whether spans are recorded
+    max_spans : int, optional
+        Only the most recent spans are kept
+    '''
+    def __init__(self, *, enabled=False, max_spans=1000000):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._spans = deque(maxlen=max_spans)
+        self._t0 = time.perf_counter()
+        self._scan = 0
+        self._scan_labels = {}
+
+    def start_scan(self, label=None):
+        '''Attribute the spans recorded from now on to a new scan'''
+        with self._lock:
+            self._scan += 1
+            self._scan_labels[self._scan] = label
+
+    def label_scan(self, label):
+        '''Name the current scan, e.g. with its scan ID'''
+        with self._lock:
+            self._scan_labels[self._scan] = label
+
+    def record(self, name, category, start, duration, args=None):
+        '''Record a span; start and duration in perf_counter seconds'''
+        with self._lock:
+            self._spans.append((name, category, start, duration,
+                                threading.get_ident(), self._scan, args))
+
+    @contextmanager
+    def span(self, name, category='', **args):
+        '''Context manager recording its body as a span'''
+        if not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, category, start, time.perf_counter() - start,
+                        args or None)
+
+    def clear(self):
+        '''Remove all recorded spans'''
+        with self._lock:
+            self._spans.clear()
+            self._scan_labels = {self._scan: self._scan_labels.get(
+                self._scan)}
+
+    def to_chrome_trace(self):
+        '''The spans in the Chrome trace event format'''
+        pid = os.getpid()
+        with self._lock:
+            spans = list(self._spans)
+            labels = dict(self._scan_labels)
+
+        events = []
+        for name, category, start, duration, tid, scan, args in spans:
+            event_args = {'scan': labels.get(scan, scan)}
+            if args:
+                event_args.update(args)
+            events.append({'name': name,
+                           'cat': category,
+                           'ph': 'X',
+                           'ts': (start - self._t0) * 1e6,
+                           'dur': duration * 1e6,
+                           'pid': pid,
+                           'tid': tid,
+                           'args': event_args,
+                           })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def dump(self, path):
+        '''Write the Chrome trace JSON to path'''
+        with open(path, 'w') as f:
+            json.dump(self.to_chrome_trace(), f, default=str)
+
+    def summary(self, scan=None):
+        '''Per-span-name statistics for one scan
+
+        Parameters
+        ----------
+        scan : optional
+            Scan label (e.g., scan ID), defaults to the current scan
+
+        Returns
+        -------
+        summary : OrderedDict
+            {name: {'count', 'total', 'mean', 'max'}}, in seconds, sorted by
+            decreasing total time
+        '''
+        with self._lock:
+            spans = list(self._spans)
+            if scan is None:
+                index = self._scan
+            else:
+                index = next((idx for idx, label
+                              in self._scan_labels.items()
+                              if label == scan), None)
+
+        totals = {}
+        for name, category, start, duration, tid, span_scan, args in spans:
+            if span_scan != index:
+                continue
+            entry = totals.setdefault(name, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += duration
+            entry[2] = max(entry[2], duration)
+
+        return OrderedDict(
+            (name, {'count': count, 'total': total, 'mean': total / count,
+                    'max': max_})
+            for name, (count, total, max_) in sorted(
+                totals.items(), key=lambda item: -item[1][1]))
+
+    def print_summary(self, scan=None):
+        '''Print the summary table of one scan'''
+        summary = self.summary(scan)
+        header = '{:<48} {:>7} {:>11} {:>11} {:>11}'.format(
+            'span', 'count', 'total (s)', 'mean (ms)', 'max (ms)')
+        print(header)
+        print('-' * len(header))
+        for name, entry in summary.items():
+            print('{:<48} {:>7} {:>11.3f} {:>11.3f} {:>11.3f}'.format(
+                name, entry['count'], entry['total'], entry['mean'] * 1e3,
+                entry['max'] * 1e3))
+
+
+tracer = Tracer()
+# (id(device), method name) of the traced methods running in this thread
+_active_methods = threading.local()
+
+
+def get_tracer():
+    '''The process-wide Tracer used by hxntools'''
+    return tracer
+
+
+def traced_method(category):
+    '''Decorate a device method to record it as '{device name}.{method}'
+
+    Overrides of the same method may all be decorated: only the outermost
+    call on a device is recorded, the overrides it reaches through super()
+    are part of its span.
+    '''
+    def wrapper(func):
+        @functools.wraps(func)
+        def wrapped(self, *args, **kwargs):
+            if not tracer.enabled:
+                return func(self, *args, **kwargs)
+
+            key = (id(self), func.__name__)
+            active = getattr(_active_methods, 'keys', None)
+            if active is None:
+                active = _active_methods.keys = set()
+            if key in active:
+                return func(self, *args, **kwargs)
+
+            active.add(key)
+            try:
+                name = '{}.{}'.format(self.name, func.__name__)
+                with tracer.span(name, category):
+                    return func(self, *args, **kwargs)
+            finally:
+                active.discard(key)
+        return wrapped
+    return wrapper
+
+
+def traced_command(name, command):
+    '''Wrap a RunEngine command coroutine to record it as a span'''
+    @asyncio.coroutine
+    @functools.wraps(command)
+    def wrapped(msg):
+        if not tracer.enabled:
+            return (yield from command(msg))
+
+        with tracer.span(name, 'command'):
+            return (yield from command(msg))
+    return wrapped